@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# bench_reader.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# bench_reader.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bench_reader.py. If not, see http://www.gnu.org/licenses/.
+
+"""Compare peak RSS and wall time of the streaming TCX reader against the old DOM+XPath path.
+
+Every measurement runs in a fresh interpreter so that peak RSS belongs to that path only.
+Usage: python benchmarks/bench_reader.py [-s 10000,100000,500000] [-l 10]"""
+
+from __future__ import print_function
+import sys, os, time, resource, subprocess, tempfile
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from synthtcx import NS, write_synthetic_tcx
+
+PATHS = ["dom", "stream"]
+
+
+def run_dom(filename):
+    """The pre-streaming path: full tree, XPath queries, every Lap element kept alive"""
+    import lxml.etree as ET
+    nsmap = {"tcd": NS}
+    etree = ET.parse(filename)
+    heart_rates = etree.xpath('.//tcd:HeartRateBpm/tcd:Value/text()', namespaces=nsmap)
+    laps = etree.xpath('.//tcd:Lap', namespaces=nsmap)
+    times = [lap.xpath('.//tcd:Trackpoint/tcd:Time/text()', namespaces=nsmap) for lap in laps]
+    return len(heart_rates), sum(len(t) for t in times)
+
+def run_stream(filename):
+    """The streaming path: one pass, one lap alive at a time"""
+    from tcxreader import iter_laps
+    heart_rates = trackpoints = 0
+    for lap, lap_trackpoints in iter_laps(filename):
+        heart_rates += sum(1 for tp in lap_trackpoints if tp.bpm is not None)
+        trackpoints += len(lap_trackpoints)
+    return heart_rates, trackpoints
+
+def measure(path, filename):
+    """Run one path in a child interpreter and return (seconds, peak RSS in MB)"""
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--run", path, filename])
+    seconds, peak_rss = output.decode().split()
+    return float(seconds), float(peak_rss)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the streaming TCX reader against the DOM+XPath path")
+    parser.add_argument("-s", "--sizes", default="10000,100000,500000", help="Comma separated numbers of Trackpoints per file")
+    parser.add_argument("-l", "--laps", type=int, default=10, help="Laps per synthetic file")
+    parser.add_argument("--run", nargs=2, metavar=("PATH", "FILE"), help="Internal: time a single PATH (dom or stream) on FILE")
+    args = parser.parse_args()
+
+    if args.run:
+        path, filename = args.run
+        start = time.time()
+        {"dom": run_dom, "stream": run_stream}[path](filename)
+        elapsed = time.time() - start
+        # ru_maxrss is in kilobytes on Linux
+        print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+        sys.exit(0)
+
+    tmpdir = tempfile.mkdtemp(prefix="tcxbench")
+    print("{0:>10} {1:>9} {2:>8} {3:>10} {4:>12}".format("trackpoints", "file (MB)", "path", "wall (s)", "peak RSS (MB)"))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        filename = os.path.join(tmpdir, "synthetic_{0}.tcx".format(size))
+        write_synthetic_tcx(filename, laps=args.laps, trackpoints_per_lap=max(1, size // args.laps))
+        file_size = os.path.getsize(filename) / 1024. / 1024.
+        for path in PATHS:
+            seconds, peak_rss = measure(path, filename)
+            print("{0:>10} {1:>9.1f} {2:>8} {3:>10.3f} {4:>12.1f}".format(size, file_size, path, seconds, peak_rss))
+        os.remove(filename)
+    os.rmdir(tmpdir)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# bench_stages.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# bench_stages.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bench_stages.py. If not, see http://www.gnu.org/licenses/.
+
+"""Time and memory-profile every stage of tcxzones and tcxaet on synthetic TCX files.
+
+Stages are the XML parse, the extraction of the trackpoint columns, the zone binning
+(tcxzones) or half-split drift (tcxaet), and the CSV output. Every scenario and tool runs
+in fresh interpreters: once per repeat for wall times, and once under tracemalloc for the
+peak memory each stage allocates on top of what it received (libxml2's own allocations
+only show in the peak RSS).
+Results are written as JSON, so that two revisions can be compared with --compare.
+Usage: python benchmarks/bench_stages.py [-s steady,long] [--scale 1] [-r 3] [-o results.json] [--compare old.json]"""
+
+from __future__ import print_function
+import sys, os, json, time, platform, resource, subprocess, tempfile, tracemalloc
+from datetime import datetime
+from argparse import ArgumentParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir))
+from synthtcx import write_synthetic_tcx
+
+MB = 1024. * 1024.
+TOOLS = ["zones", "aet"]
+ZONES_EDGES = [0, 120, 140, 160, 200]
+
+# Synthetic file parameters of every scenario, as accepted by write_synthetic_tcx
+SCENARIOS = {
+    "steady":          dict(activities=1, laps=10, trackpoints_per_lap=1000),
+    "long":            dict(activities=1, laps=3, trackpoints_per_lap=3600),
+    "multi-activity":  dict(activities=5, laps=4, trackpoints_per_lap=500),
+    "smart-recording": dict(activities=1, laps=10, trackpoints_per_lap=1000, gap_rate=0.3, max_gap=10),
+    "sparse-hr":       dict(activities=1, laps=10, trackpoints_per_lap=1000, missing_hr=0.2),
+    "indoor":          dict(activities=1, laps=10, trackpoints_per_lap=1000, missing_gps=1.0),
+}
+
+
+def zones_stages(filename):
+    """Yield (stage, function) pairs reproducing tcxzones on filename, every function taking the previous result"""
+    import csv
+    from io import StringIO
+    from tcxreader import iter_tcx, columns_from_events
+    from tcxlib import bin_activities, create_zones_names
+    from tcxzones import csv_float
+
+    def output(counts):
+        # As tcxzones writes its distribution
+        out = StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        for name, frequency in zip(create_zones_names(ZONES_EDGES), counts / counts.sum()):
+            writer.writerow([name, csv_float(frequency)])
+        return out.getvalue()
+    with open(filename, "rb") as tcx_file:
+        yield "parse", lambda _: list(iter_tcx(tcx_file))
+    yield "extract", columns_from_events
+    yield "bin", lambda columns: bin_activities(columns, ZONES_EDGES).sum(axis=0)
+    yield "output", output
+
+def aet_stages(filename):
+    """Yield (stage, function) pairs reproducing tcxaet (in UTC) on filename, every function taking the previous result"""
+    from tcxreader import iter_tcx, columns_from_events, file_laps
+    from tcxlib import parse_tcx_lap, parse_laps
+    from tcxaet import csv_output
+    # tcxaet imports pandas when it first writes csv: imported here, the output stage times the formatting only
+    import pandas
+
+    def half_split(columns):
+        laps = parse_tcx_lap((os.path.basename(filename), lap) for lap in file_laps(columns))
+        return parse_laps(laps, local_time=False)
+    with open(filename, "rb") as tcx_file:
+        yield "parse", lambda _: list(iter_tcx(tcx_file))
+    yield "extract", columns_from_events
+    yield "half-split", half_split
+    yield "output", lambda rows: csv_output(rows, columns=True)
+
+def run_stages(tool, filename, memory=False):
+    """Run the stages of tool on filename. Return a dictionary of the stages' measurements:
+       wall time, or the peak of tracemalloc's allocations if memory, and the process' peak RSS"""
+    stages = zones_stages if tool == "zones" else aet_stages
+    results = {}
+    result = None
+    if memory:
+        tracemalloc.start()
+    for stage, function in stages(filename):
+        if memory:
+            tracemalloc.reset_peak()
+            held = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = function(result)
+        elapsed = time.perf_counter() - start
+        measure = {"max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}   # kilobytes on Linux
+        if memory:
+            # Only the memory allocated on top of what earlier stages (and imports) still hold
+            measure["peak_alloc_mb"] = (tracemalloc.get_traced_memory()[1] - held) / MB
+        else:
+            measure["seconds"] = elapsed
+        results[stage] = measure
+    return results
+
+def measure(tool, filename, memory=False):
+    """Run the stages of tool on filename in a child interpreter and return their measurements"""
+    command = [sys.executable, os.path.abspath(__file__), "--run", tool, filename] + (["--memory"] if memory else [])
+    return json.loads(subprocess.check_output(command, stderr=subprocess.DEVNULL).decode())
+
+def benchmark(scenario, tool, filename, repeats):
+    """Return the stages of tool on filename, with the best wall time of repeats runs and the peak allocations"""
+    timings = [measure(tool, filename) for _ in range(repeats)]
+    stages = measure(tool, filename, memory=True)
+    for stage, values in stages.items():
+        values["seconds"] = min(timing[stage]["seconds"] for timing in timings)
+        values["max_rss_mb"] = min(timing[stage]["max_rss_mb"] for timing in timings)
+    return stages
+
+def revision():
+    """Return the git revision of the working tree, None outside a git checkout"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, baseline=None):
+    """Print a table of the results, with the ratio to the same measurement in baseline if given"""
+    previous = dict(((r["scenario"], r["tool"]), r["stages"]) for r in baseline["results"]) if baseline else {}
+    print("{0:>16} {1:>6} {2:>11} {3:>10} {4:>11} {5:>10}{6}".format("scenario", "tool", "stage", "wall (s)", "alloc (MB)",
+                                                                   "RSS (MB)", "  vs baseline" if baseline else ""))
+    for result in results:
+        for stage, values in result["stages"].items():
+            line = "{0:>16} {1:>6} {2:>11} {3:>10.4f} {4:>11.1f} {5:>10.1f}".format(
+                result["scenario"], result["tool"], stage, values["seconds"], values["peak_alloc_mb"], values["max_rss_mb"])
+            old = previous.get((result["scenario"], result["tool"]), {}).get(stage)
+            if old:
+                line += "  {0:>10.2f}x".format(values["seconds"] / old["seconds"])
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Time and memory-profile every stage of tcxzones and tcxaet on synthetic TCX files")
+    parser.add_argument("-s", "--scenarios", default=",".join(sorted(SCENARIOS)), help="Comma separated scenarios (default: all of {0})".format(", ".join(sorted(SCENARIOS))))
+    parser.add_argument("--scale", type=float, default=1., help="Multiply the Trackpoints per lap of every scenario")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Timing runs per scenario and tool, the best one is kept")
+    parser.add_argument("-o", "--output", default=None, help="Write the results as JSON to OUTPUT")
+    parser.add_argument("--compare", default=None, help="Compare wall times to the JSON results of another revision")
+    parser.add_argument("--run", nargs=2, metavar=("TOOL", "FILE"), help="Internal: run the stages of TOOL (zones or aet) on FILE")
+    parser.add_argument("--memory", action="store_true", help="Internal: with --run, measure allocations instead of time")
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_stages(args.run[0], args.run[1], args.memory)))
+        sys.exit(0)
+
+    import numpy as np
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix="tcxbench")
+    for scenario in args.scenarios.split(","):
+        params = dict(SCENARIOS[scenario])
+        params["trackpoints_per_lap"] = max(1, int(params["trackpoints_per_lap"] * args.scale))
+        filename = os.path.join(tmpdir, scenario + ".tcx")
+        trackpoints = write_synthetic_tcx(filename, **params)
+        for tool in TOOLS:
+            results.append({"scenario": scenario, "tool": tool, "params": params, "trackpoints": trackpoints,
+                            "file_mb": os.path.getsize(filename) / MB,
+                            "stages": benchmark(scenario, tool, filename, args.repeats)})
+        os.remove(filename)
+    os.rmdir(tmpdir)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"revision": revision(), "date": datetime.now().isoformat(), "python": platform.python_version(),
+                       "numpy": np.__version__, "machine": platform.machine(), "processor": platform.processor(),
+                       "repeats": args.repeats, "scale": args.scale, "results": results}, output, indent=1)
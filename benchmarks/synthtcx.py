@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# synthtcx.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# synthtcx.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with synthtcx.py. If not, see http://www.gnu.org/licenses/.
+
+"""Deterministic synthetic TCX files for benchmarks.
+
+The same parameters and seed always produce the same file, byte for byte.
+Usage: python benchmarks/synthtcx.py [-a 1] [-l 10] [-p 1000] [--gap-rate 0] [--missing-hr 0] [--missing-gps 0] FILE"""
+
+from __future__ import print_function
+import random
+from datetime import datetime, timedelta
+from argparse import ArgumentParser
+
+NS = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
+START = datetime(2020, 1, 1, 8, 0, 0)
+
+
+def write_synthetic_tcx(path, activities=1, laps=10, trackpoints_per_lap=1000, gap_rate=0., max_gap=60,
+                        missing_hr=0., missing_gps=0., seed=0):
+    """Write a TCX file of activities, each with laps of trackpoints_per_lap Trackpoints, normally 1 second apart.
+       gap_rate is the probability of a sampling gap of 2 to max_gap seconds after a Trackpoint ("smart recording"),
+       missing_hr and missing_gps the probabilities of a Trackpoint without heart rate or position.
+       Return the number of Trackpoints written"""
+    rng = random.Random(seed)
+    written = 0
+    with open(path, "w") as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n<TrainingCenterDatabase xmlns="{0}">\n<Activities>\n'.format(NS))
+        for activity in range(activities):
+            # One activity a day, starting from the same place
+            now = START + timedelta(days=activity)
+            distance, bpm, lat, lon = 0., 100., 41.8, -87.6
+            out.write('<Activity Sport="Running"><Id>{0}Z</Id>\n'.format(now.isoformat()))
+            for lap in range(laps):
+                lap_start, lap_distance = now, distance
+                trackpoints = []
+                for i in range(trackpoints_per_lap):
+                    parts = ['<Trackpoint><Time>{0}Z</Time>'.format(now.isoformat())]
+                    if rng.random() >= missing_gps:
+                        parts.append('<Position><LatitudeDegrees>{0:.6f}</LatitudeDegrees><LongitudeDegrees>{1:.6f}'
+                                     '</LongitudeDegrees></Position>'.format(lat, lon))
+                    parts.append('<DistanceMeters>{0:.1f}</DistanceMeters>'.format(distance))
+                    if rng.random() >= missing_hr:
+                        parts.append('<HeartRateBpm><Value>{0}</Value></HeartRateBpm>'.format(int(bpm)))
+                    parts.append('</Trackpoint>\n')
+                    trackpoints.append("".join(parts))
+                    step = rng.randint(2, max_gap) if rng.random() < gap_rate else 1
+                    now += timedelta(seconds=step)
+                    distance += step * rng.uniform(2.5, 3.5)
+                    # A slow random walk, kept in a plausible range
+                    bpm = min(190., max(90., bpm + rng.uniform(-1., 1.1)))
+                    lat += step * 1e-5
+                    lon += step * 1e-5
+                out.write('<Lap StartTime="{0}Z"><TotalTimeSeconds>{1}</TotalTimeSeconds><DistanceMeters>{2:.1f}'
+                          '</DistanceMeters><Track>\n'.format(lap_start.isoformat(), (now - lap_start).total_seconds(),
+                                                               distance - lap_distance))
+                out.write("".join(trackpoints))
+                out.write('</Track></Lap>\n')
+                written += len(trackpoints)
+            out.write('</Activity>\n')
+        out.write('</Activities>\n</TrainingCenterDatabase>\n')
+    return written
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Write a deterministic synthetic TCX file")
+    parser.add_argument("-a", "--activities", type=int, default=1, help="Activities in the file")
+    parser.add_argument("-l", "--laps", type=int, default=10, help="Laps per activity")
+    parser.add_argument("-p", "--points", type=int, default=1000, help="Trackpoints per lap")
+    parser.add_argument("--gap-rate", type=float, default=0., help="Probability of a sampling gap after a Trackpoint")
+    parser.add_argument("--max-gap", type=int, default=60, help="Longest sampling gap, in seconds")
+    parser.add_argument("--missing-hr", type=float, default=0., help="Probability of a Trackpoint without heart rate")
+    parser.add_argument("--missing-gps", type=float, default=0., help="Probability of a Trackpoint without position")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("file", help="The TCX file to write")
+    args = parser.parse_args()
+    write_synthetic_tcx(args.file, args.activities, args.laps, args.points, args.gap_rate, args.max_gap,
+                        args.missing_hr, args.missing_gps, args.seed)
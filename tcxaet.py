@@ -18,29 +18,17 @@
 
 
 from __future__ import print_function
-from ntpath import  basename 
-import sys, re, os
-from datetime import datetime, timedelta
+import sys
+from io import StringIO
 from argparse import ArgumentParser, SUPPRESS, REMAINDER
-import lxml.etree as ET
-import pandas as pd
-from imath import floor
-
-# CONSTANTS    
-# Defining a dictionary of Garmin's TCX format namespaces
-# All non-default namespaces defined in Garmin's TCX files asof Jan 2020, for future reference 
-#NSMAP = {"ns5" : "http://www.garmin.com/xmlschemas/ActivityGoals/v1",
-         #"ns3" : "http://www.garmin.com/xmlschemas/ActivityExtension/v2",
-         #"ns2" : "http://www.garmin.com/xmlschemas/UserProfile/v2",
-         #"tcd" : "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2",
-         #"xsi" : "http://www.w3.org/2001/XMLSchema-instance", 
-         #"ns4" : "http://www.garmin.com/xmlschemas/ProfileExtension/v1"}
-
-# Garmin's TCX format default namespace
-NSMAP = {"tcd" : "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"}
-# Other useful constant
-METERS2MILES = 1609.34
-MIN2SECS = 60 # for clarity in formulas
+from functools import partial
+import tcxtz
+from tcxreader import recorded_values
+from tcxlib import HAS_TIMEZONEFINDER, LAP_COLUMNS, CURVE_COLUMNS, read_tcx_files, parse_tcx_lap, parse_laps, drift_curves
+from tcxcache import add_cache_arguments, cache_from_args, evict
+from tcxpool import map_files, jobs_number
+from tcxprofile import add_profile_arguments, ProfileSession, stage
+from tcxexport import add_export_arguments, export_from_args, export_laps, export_curves, export_trackpoints
 
 # Parsing command line arguments, using options for required arguments
 # Disable default help
@@ -55,182 +43,51 @@ optional.add_argument('-h','--help',action='help',default=SUPPRESS,help='show th
 required.add_argument("file_list", nargs=REMAINDER, help="One or more TCX or FIT files containing heart rate data for one or more activities", type=str)
 optional.add_argument("-d", "--details", action="store_true", default=False, help="Print more data about every lap")
 optional.add_argument("-c", "--columns", action="store_true", default=False, help="Print column headers in output")
+optional.add_argument("-o", "--output", default=None, help="Write the csv output to OUTPUT instead of the standard output")
 optional.add_argument("-l", "--local-time", action="store_true", default=True, help="Converts laps's UTC time to local time. Needs timezonefinder package installed ")
+optional.add_argument("--tz-in-memory", action="store_true", default=False, help="Load all time zone data in memory: slower start, faster lookups for large batches")
+optional.add_argument("-j", "--jobs", type=jobs_number, default=1, help="Process files in parallel with JOBS processes (0 for one per CPU)")
+optional.add_argument("-n", "--segments", type=int, default=None, help="Also print the drift curve of every lap over SEGMENTS equal segments")
+optional.add_argument("-W", "--window", type=float, default=None, metavar="MINUTES", help="Also print the drift curve of every lap over sliding windows of MINUTES minutes")
+optional.add_argument("-S", "--stride", type=float, default=None, metavar="SECONDS", help="With --window, start a new window every SECONDS seconds (default: one window length)")
+add_cache_arguments(optional)
+add_export_arguments(optional)
+add_profile_arguments(optional)
 # the treadmill option accepts a single parameter for the dummy treadmill pace, defaults to 12 min/mi if the option is given with no value, and to False if not given  
-optional.add_argument("-t", "--treadmill", default=None, nargs="?", const = 12,  help="Interpret data as treadmill data (set speed/pace to a program defined constant)")
-args = parser.parse_args()
-
-if args.treadmill:
-    args.treadmill = float(args.treadmill)
-                      
-try:
-    from timezonefinder import TimezoneFinder
-    import pytz
-except:
-    print("timezonefinder package not installed. Using UTC time and ignoring --local-time option.")
-    args.local_time=False
-
+optional.add_argument("-t", "--treadmill", default=None, nargs="?", const = 12, type=float,  help="Interpret data as treadmill data (set speed/pace to a program defined constant)")
 
 # FUNCTIONS
-
-def UTC_datetime2local(datetime, coords):
-    """Convert TCX UTC's datetimes to local time"""
-
-    datetime = pytz.utc.localize(datetime) #Garmin's TCX datetimes are always UTC, but only implicitly 
-    return datetime.astimezone(pytz.timezone(TimezoneFinder().timezone_at(lng=coords[0], lat=coords[1])))
-        
-def mil_min_val_to_mil_min_string(val):
-    """Convert a decimal miles/min value into a standard formatted string."""
-    if val == 0:
-        return "00:00"
-    else:
-        delta = timedelta(minutes=val)
-        l = str(delta).split(":")
-        return l[-2]+":"+str(round(float(l[-1]))).zfill(2)
-
-    
-def meter_sec_2_min_miles(n):
-    """Convert m/s speed into a minutes/mil pace value (i.e. decimal minutes) """
-    miles_a_minute = n/METERS2MILES*60
-    if miles_a_minute == 0:
-        return 0
-    else:
-        return  1/miles_a_minute
-    
-def min_miles2meter_sec(n):
-    """Convert decimal miles a minute pace into speed in m/s"""
-    secs_per_meter = n* 60 /METERS2MILES
-    return 1/secs_per_meter
-
-    
-# PARSE MULTIPLE FILES INTO COLLECTIONS OF LAPS
-def read_tcx_files(filename_list):
-    """ Read all laps from a collection of TCX files. 
-        Return a list of tuples (filename, tcx lap)"""
-    all_laps = []
-    for filename in filename_list:
-        with open(filename,"r+") as tcx_file:
-            lap_file = basename(filename)
-            etree = ET.parse(tcx_file)
-            file_laps = etree.xpath('.//tcd:Lap', namespaces=NSMAP)
-            for lap in file_laps:
-                all_laps.append((lap_file, lap))
-    return all_laps
-
-def parse_tcx_lap(file_laps):
-    """ Parse a TCX lap into a dictionary of relevant data.
-        Return dictionary"""
-    laps=[]   
-    for (filename,lap) in file_laps:
-        lap_data = {}
-        # Indoor activities may not record GPS coordinates, skip if missing
-        try:
-            lap_data['Lap_coords']       = (float(lap.xpath('.//tcd:Track/tcd:Trackpoint/tcd:Position/tcd:LongitudeDegrees/text()', namespaces=NSMAP)[0]),
-                                            float(lap.xpath('.//tcd:Track/tcd:Trackpoint/tcd:Position/tcd:LatitudeDegrees/text()', namespaces=NSMAP)[0]))
-        except IndexError as e:
-            lap_data['Lap_coords'] = []
-            print("Lap description has no coordinates, and it may be an indoor activity. Cannot determine time zone and will use UTC time instead.", file=sys.stderr)
-            
-        lap_data['Filename']         = filename
-        lap_data['TotalTimeSeconds'] = int(float(lap.xpath('.//tcd:TotalTimeSeconds/text()',namespaces=NSMAP)[0]))
-        lap_data['DistanceMeters']   = [float(i) for i in lap.xpath('.//tcd:DistanceMeters/text()',namespaces=NSMAP)[1:]]
-        # create a panda time-indexed dataframe for BPM and distance (and possibly other data if present)
-        Bpm         = [int(str(i)) for i in lap.xpath('.//tcd:HeartRateBpm/tcd:Value/text()',namespaces=NSMAP)]
-        Distance    = [int(float(i)) for i in lap.xpath('.//tcd:Track/tcd:Trackpoint/tcd:DistanceMeters/text()',namespaces=NSMAP)]
-        Time        = [pd.to_datetime(str(i)) for i in lap.xpath('.//tcd:Trackpoint/tcd:Time/text()',namespaces=NSMAP)]
-        if len(Bpm) != len(Distance) != len(Time):
-            raise Exception("There is some seriously wrong with the TCX file: the Trackpoints do not contain homogenous data")
-        lap_data['Trackpoints_series'] = pd.DataFrame({'Bpm':Bpm, 'Distance':Distance}, index=Time)
-        laps.append(lap_data)
-    return laps
-
-def datetime64_2_datetime(aNumpyDaytime64):
-        """Convert a numpy datetime64 object into a regular pythone datetime"""
-        return pd.Timestamp(aNumpyDaytime64).to_pydatetime()
-    
-def get_lap_times_and_duration(lap_data):
-    """Extract beginning time, end time, and duration from lap info and format appropriately.
-       Convert TCX's UTC time to lap's local time if passed long and lat coords.  
-       Return a tuple with the formatted info"""
-    
-    beginning_time=lap_data['Trackpoints_series'].index.values[0]
-    end_time = lap_data['Trackpoints_series'].index.values[-1]
-    if  lap_data['Lap_coords'] and args.local_time:
-        # numpy datetime64 is always UTC and does not know about timezones. 
-        # Need to convert to regular python datetime objects first
-        beginning_time = datetime64_2_datetime(beginning_time)
-        end_time = datetime64_2_datetime(end_time)
-        beginning_time = UTC_datetime2local(beginning_time, lap_data['Lap_coords']) 
-        end_time = UTC_datetime2local(end_time, lap_data['Lap_coords']) 
-    duration = end_time - beginning_time
-    return (beginning_time, end_time, duration)
-
-def lap_halftime_value(lap):
-    """Return the time corresponding to the half point of the lap."""
-
-    return lap['Trackpoints_series'].index.min() + ((lap['Trackpoints_series'].index.max()-lap['Trackpoints_series'].index.min())/2)
-    
-# PARSE SINGLE LAPS' DATA
-def parse_laps(laps):
-    """ Parse each lap's basic info into a panda dataframe of extracted and computed data.  
-        Return the dataframe."""
-     
-    all_laps_data = [] # the list of dictionaries for the dataframe data 
-    for i, lap in enumerate(laps):
-        try:
-            lap_row = {}  # a row in the dataframe with all the data for the lap
-            # general info
-            lap_row["Filename"] = lap["Filename"]
-            lap_row["Beginning time"] = get_lap_times_and_duration(lap)[0]
-            lap_row["End time"] = get_lap_times_and_duration(lap)[1]
-            lap_row["Duration"] = get_lap_times_and_duration(lap)[2]
-
-            # All lap data
-            lap_row["Total distance"] = lap['Trackpoints_series']['Distance'][-1]-float( lap['Trackpoints_series']['Distance'][0])
-            lap_row["# Trackpoints"] =  lap['Trackpoints_series'].size                                                                              
-            lap_row["Total time"] = lap['TotalTimeSeconds']                                                                      
-            lap_row["Avg. BPM"] = lap['Trackpoints_series']['Bpm'].mean()                                    
-            # using dummy speed value (and hence compute dummy pace) if treadmill option is active
-            if not args.treadmill:
-                lap_row["Speed (m/s)"] = lap_row["Total distance"]/lap_row["Total time"]
-            else: 
-                lap_row["Speed (m/s)"] = min_miles2meter_sec(args.treadmill)
-
-            lap_row["Pace (min:mi)"] = mil_min_val_to_mil_min_string(meter_sec_2_min_miles(lap_row["Speed (m/s)"]))
-            lap_row['Trackpoints'] = lap['Trackpoints_series']
-            lap_row["Halftime"] = lap_halftime_value(lap)
-
-            # First half data
-            first_half = lap['Trackpoints_series'].truncate(after = lap_row["Halftime"])
-            lap_row["1st half distance"] = first_half['Distance'].max() - first_half['Distance'].min()
-            if not args.treadmill:
-                lap_row["1st half speed (m/s)"] = lap_row["1st half distance"]/(lap_row["Total time"] / 2)                                                          
-            else: 
-                lap_row["1st half speed (m/s)"] = min_miles2meter_sec(args.treadmill)
-                
-            lap_row["1st half pace (min:mi)"] = mil_min_val_to_mil_min_string(meter_sec_2_min_miles(lap_row["1st half speed (m/s)"]))
-            lap_row["1st half avg. BPM"] = first_half['Bpm'].mean()      
-            lap_row["1st half speed/avg. BPM ratio"] = lap_row["1st half speed (m/s)"]/lap_row["1st half avg. BPM"]
-
-            # Second half data
-            second_half = lap['Trackpoints_series'][lap_halftime_value(lap):lap['Trackpoints_series'].index.max()] 
-            lap_row["2nd half distance"] = second_half['Distance'].max() -   second_half['Distance'].min()                     
-            if not args.treadmill:
-                lap_row["2nd half speed (m/s)"] = lap_row["2nd half distance"]/(lap_row["Total time"] / 2)                                                                     
-            else: 
-                lap_row["2nd half speed (m/s)"] = min_miles2meter_sec(args.treadmill)
-            lap_row["2nd half pace (min:mi)"] = mil_min_val_to_mil_min_string(meter_sec_2_min_miles(lap_row["2nd half speed (m/s)"]))
-            lap_row["2nd half avg. BPM"]= second_half['Bpm'].mean()      
-            lap_row["2nd half speed/avg. BPM ratio"] = lap_row["2nd half speed (m/s)"]/lap_row["2nd half avg. BPM"]
-                                                         
-            # 1st/2nd half cardiac drift
-            lap_row["1st/2nd half drift"] = (lap_row["2nd half speed/avg. BPM ratio"]-lap_row["1st half speed/avg. BPM ratio"])/lap_row["1st half speed/avg. BPM ratio"]
-            lap_row['1st/2nd hald BPM-only drift'] = (lap_row["2nd half avg. BPM"] - lap_row["1st half avg. BPM"]) / lap_row["1st half avg. BPM"]
-        except ZeroDivisionError as e:
-            print(e, file=sys.stderr)
-            print("Lap {} has 0 distance and/or 0 time. Skipping ".format(i), file=sys.stderr)
-        all_laps_data.append(lap_row)
-    return pd.DataFrame(all_laps_data)
+# CONSTANTS
+SHORT_COLUMNS = ["Filename", "Beginning time", "End time", "Duration", "1st/2nd half drift", 'Avg. BPM', '1st half avg. BPM', '2nd half avg. BPM', '1st/2nd hald BPM-only drift']
+# --details prints all columns, with every lap's trackpoints after its pace
+DETAIL_COLUMNS = LAP_COLUMNS[:LAP_COLUMNS.index("Halftime")] + ["Trackpoints"] + LAP_COLUMNS[LAP_COLUMNS.index("Halftime"):]
+
+def process_file(filename, treadmill=None, local_time=True, cache=None, tz_in_memory=False,
+                 segments=None, window=None, stride=None, details=False, export=None):
+    """Parse a single TCX file into its list of lap rows and, if segments or window are given,
+       its drift curves table (a worker for the -j/--jobs process pool). With export settings,
+       write them, and optionally the trackpoints, as columnar files too.
+       The laps' trackpoints are dropped once the file is done, but for their text in the details rows"""
+    tcxtz.configure(in_memory=tz_in_memory)
+    laps = parse_tcx_lap(read_tcx_files([filename], cache))
+    curves = drift_curves(laps, segments, window, stride, treadmill) if segments or window else None
+    laps_rows = parse_laps(laps, treadmill, local_time)
+    if export and laps:
+        with stage("export"):
+            lap_records = [lap['Lap'] for lap in laps]
+            export_laps(export, filename, laps_rows, lap_records, LAP_COLUMNS)
+            if curves is not None:
+                export_curves(export, filename, curves, lap_records)
+            if export.trackpoints:
+                export_trackpoints(export, filename, lap_records)
+    if details:
+        add_trackpoints_column(laps_rows, laps)
+    return laps_rows, curves
+
+def lap_to_frame(lap):
+    """Return a lap's trackpoints as a time-indexed panda dataframe of BPM and distance"""
+    import pandas as pd
+    return pd.DataFrame({'Bpm': lap.bpm, 'Distance': recorded_values(lap.distance)}, index=pd.to_datetime(lap.time, utc=True))
 
 # def make_lap_header(lap):
 #     """Return a string with all the info about the input lap"""
@@ -250,24 +107,94 @@ def parse_laps(laps):
 #     return lap_header
 
 
+def add_trackpoints_column(laps_rows, laps):
+    """Add the text of every lap's trackpoints dataframe to its row, as the Trackpoints column of --details.
+       Laps skipped for 0 time have no speed, and get no trackpoints either"""
+    for lap_row, lap in zip(laps_rows, laps):
+        if "Speed (m/s)" in lap_row:
+            lap_row["Trackpoints"] = str(lap_to_frame(lap['Lap']))
+
+
 # OUTPUT CSV-FORMATTED DATA        
-def csv_output(laps_array):
-    """Return a csv formatted string with either a short or a long 
-       version of the data in the array and optionally the column headers"""
+def write_csv_rows(out, laps_rows, first_lap=0, details=False, columns=False):
+    """Write lap rows to out as csv, with either the short or the long (details) set of columns,
+       numbering laps from first_lap. Column headers, if requested, only precede lap 0,
+       so that the rows of every file can be written as soon as the file is done"""
+    if not laps_rows:
+        return
+    # pandas is only imported when csv is written: exports and runs without laps never load it
+    import pandas as pd
     index_name = "lap"
-    if not args.details:
-        columns_to_write = ["Filename", "Beginning time", "End time", "Duration", "1st/2nd half drift", 'Avg. BPM', '1st half avg. BPM', '2nd half avg. BPM', '1st/2nd hald BPM-only drift']
-    else:
-        columns_to_write = None                  # Pandas' to_csv print all columns when passed None as arg to param columns 
-    if args.columns == 0:
-        return laps_array.to_csv(columns = columns_to_write,header=False)
+    laps_array = pd.DataFrame(laps_rows, columns=DETAIL_COLUMNS if details else SHORT_COLUMNS,
+                              index=pd.RangeIndex(first_lap, first_lap + len(laps_rows)))
+    if not columns or first_lap > 0:
+        laps_array.to_csv(out, header=False)
     else:
-        return laps_array.to_csv(columns = columns_to_write,header=True, index_label=index_name)
+        laps_array.to_csv(out, header=True, index_label=index_name)
+
+def csv_output(laps_rows, details=False, columns=False):
+    """Return a csv formatted string with either a short or a long 
+       version of the data in the lap rows and optionally the column headers"""
+    out = StringIO()
+    write_csv_rows(out, laps_rows, 0, details, columns)
+    return out.getvalue()
+
+def curves_csv_output(curves_tables, columns=False):
+    """Return a csv formatted string with the long-format drift curves tables, one row per lap and window,
+       and optionally the column headers"""
+    import pandas as pd
+    curves = pd.concat([pd.DataFrame(table, columns=CURVE_COLUMNS) for table in curves_tables] or [pd.DataFrame(columns=CURVE_COLUMNS)])
+    return curves.to_csv(index=False, header=columns)
 
 
 # main loop
 if __name__ == "__main__":
-    # parse all files into the array
-    parsed_array = parse_laps(parse_tcx_lap(read_tcx_files(args.file_list)))
-    # output data as csv with optional header
-    print(csv_output(parsed_array))
\ No newline at end of file
+    args = parser.parse_args()
+    if args.local_time and not HAS_TIMEZONEFINDER:
+        print("timezonefinder package not installed. Using UTC time and ignoring --local-time option.")
+        args.local_time=False
+    if args.segments is not None and args.segments < 1:
+        parser.error("--segments must be at least 1")
+    if args.segments and args.window:
+        parser.error("--segments and --window cannot be used together")
+    if args.stride is not None and args.window is None:
+        parser.error("--stride needs --window")
+    if (args.window is not None and args.window <= 0) or (args.stride is not None and args.stride <= 0):
+        parser.error("--window and --stride must be positive")
+
+    export = export_from_args(args, parser)
+
+    # --profile/--cprofile instrumentation covers the whole run
+    with ProfileSession(args):
+        # parse all files into lap rows, possibly in parallel, keeping the files' order.
+        # Only one file's rows are held at a time
+        cache = cache_from_args(args)
+        worker = partial(process_file, treadmill=args.treadmill, local_time=args.local_time, cache=cache,
+                         tz_in_memory=args.tz_in_memory, segments=args.segments,
+                         window=args.window * 60 if args.window else None, stride=args.stride,
+                         details=args.details and not export, export=export)
+        out = open(args.output, "w") if args.output else sys.stdout
+        laps_number = 0
+        curves = []
+        for file_rows, file_curves in map_files(worker, args.file_list, args.jobs):
+            if file_curves is not None and not export:
+                # Number the curves' laps as the rows of the summary table
+                file_curves["lap"] = file_curves["lap"] + laps_number
+                curves.append(file_curves)
+            # output data as csv with optional header, as soon as every file is done,
+            # unless it has been exported in columnar form by the worker
+            if not export:
+                with stage("output"):
+                    write_csv_rows(out, file_rows, laps_number, args.details, args.columns)
+                    out.flush()
+            laps_number += len(file_rows)
+        if cache:
+            evict(cache.directory, cache.max_bytes)
+        if not export:
+            with stage("output"):
+                print(file=out)
+                # and the drift curves after the laps, in long format: one row per lap and window
+                if args.segments or args.window:
+                    print(curves_csv_output(curves, args.columns), file=out)
+        if args.output:
+            out.close()
\ No newline at end of file
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# tcxbatch.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# tcxbatch.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tcxbatch.py. If not, see http://www.gnu.org/licenses/.
+
+"""Zone distributions of many athletes, each with their own zones, in a single run.
+
+A manifest lists every athlete's zones and TCX files (glob patterns, relative to the manifest's
+directory). As CSV, with the columns athlete, zones and files (several patterns separated by ";"):
+
+    athlete,zones,files
+    alice,"0,120,140,160,200",alice/*.tcx
+    bob,"0,110,130,150,190",bob/2020/*.tcx;shared/bob-*.tcx
+
+or as JSON, a list of {"athlete": ..., "zones": ..., "files": ...} objects, or an object mapping
+athlete names to {"zones": ..., "files": ...}; zones and files may be strings or lists.
+Every file is read once, even if several athletes list it, and binned against the zones of
+each athlete listing it. Distributions can be grouped by the (UTC) week or month activities start in.
+
+Usage: tcxbatch.py [-g week|month] [-w] [-c] [-j JOBS] MANIFEST"""
+
+from __future__ import print_function
+import sys, os, csv, glob, json
+from collections import namedtuple, OrderedDict
+from argparse import ArgumentParser, SUPPRESS
+from functools import partial
+import numpy as np
+from tcxlib import (DEFAULT_MAX_GAP, report_skipped, load_source, check_heart_rates, validate_zones_list,
+                    create_zones_names, bin_activities, normed_rows)
+from tcxreader import NAT, activity_start_times
+from tcxcache import add_cache_arguments, cache_from_args, evict
+from tcxpool import map_files, jobs_number
+
+# CONSTANTS
+GROUPS = ["week", "month"]
+# The period of all activities when they are not grouped, and of activities without any time
+ALL_PERIODS = "all"
+UNKNOWN_PERIOD = "unknown"
+
+Athlete = namedtuple("Athlete", ["name", "zones_edges", "files"])
+
+
+# THE MANIFEST
+def expand_patterns(patterns, directory):
+    """Return the files matching a list of glob patterns, relative to directory, sorted and without duplicates"""
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.join(directory, os.path.expanduser(pattern.strip())), recursive=True))
+        if not matches:
+            print(pattern, "matches no file. Skipping", file=sys.stderr)
+        files.extend(os.path.normpath(match) for match in matches)
+    return list(OrderedDict.fromkeys(files))
+
+def read_manifest(filename):
+    """Read a CSV or JSON (by its extension) manifest of athletes, zones and file patterns.
+       Return a list of Athletes in manifest order; several entries of one athlete add up their files.
+       Raise ValueError for incomplete entries, invalid zones, or an athlete given two different zones"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    with open(filename) as manifest:
+        if filename.lower().endswith(".json"):
+            entries = json.load(manifest)
+            if isinstance(entries, dict):
+                entries = [dict(entry, athlete=name) for name, entry in entries.items()]
+        else:
+            entries = list(csv.DictReader(manifest))
+    athletes = OrderedDict()
+    for entry in entries:
+        name, zones, patterns = entry.get("athlete"), entry.get("zones"), entry.get("files")
+        if not name or not zones or not patterns:
+            raise ValueError("Manifest entries need an athlete, zones and files: {0}".format(entry))
+        # The same zones validation as tcxzones' -z, whatever the manifest's format
+        zones_edges = validate_zones_list(zones if isinstance(zones, str) else ",".join(str(edge) for edge in zones))
+        try:
+            create_zones_names(zones_edges)
+        except ValueError as e:
+            raise ValueError("{0}: {1}".format(name, e))
+        files = expand_patterns(patterns.split(";") if isinstance(patterns, str) else patterns, directory)
+        if name not in athletes:
+            athletes[name] = Athlete(name, zones_edges, files)
+        elif athletes[name].zones_edges != zones_edges:
+            raise ValueError("{0}: two different zones in the manifest".format(name))
+        else:
+            athletes[name].files.extend(f for f in files if f not in athletes[name].files)
+    return list(athletes.values())
+
+
+# BINNING
+def bin_file(task, cache=None, time_weighted=False, max_gap=DEFAULT_MAX_GAP):
+    """Read a TCX file once and bin it against several zones (a worker for the -j/--jobs process pool).
+       task is a pair (filename, list of zones edges tuples). Return a tuple (activities' start times,
+       dictionary of per-activity zone counts by zones edges tuple), or None if the file was skipped"""
+    filename, zones_sets = task
+    try:
+        columns = load_source(filename, cache)
+        check_heart_rates(columns)
+        counts = dict((edges, bin_activities(columns, edges, time_weighted, max_gap)) for edges in zones_sets)
+        return activity_start_times(columns), counts
+    except Exception as e:
+        report_skipped(filename, e)
+    return None
+
+def period_of(epoch_ns, group=None):
+    """Return the period of an activity started at epoch_ns: its ISO week (2020-W01), its month (2020-01),
+       or ALL_PERIODS if group is None"""
+    if group is None:
+        return ALL_PERIODS
+    if epoch_ns == NAT:
+        return UNKNOWN_PERIOD
+    day = np.datetime64(int(epoch_ns), "ns").astype("datetime64[D]").item()
+    if group == "week":
+        year, week, _ = day.isocalendar()
+        return "{0:04d}-W{1:02d}".format(year, week)
+    return "{0:04d}-{1:02d}".format(day.year, day.month)
+
+def batch_zone_counts(athletes, group=None, jobs=1, cache=None, time_weighted=False, max_gap=DEFAULT_MAX_GAP):
+    """Bin the files of every athlete against the athlete's zones, grouping activities by period (see period_of).
+       Files are read once, using up to jobs processes. Return a tuple (OrderedDict mapping (athlete name, period)
+       to zone counts, in manifest order and then by period, list of skipped files)"""
+    athletes_of = OrderedDict()
+    for athlete in athletes:
+        for filename in athlete.files:
+            athletes_of.setdefault(filename, []).append(athlete)
+    # Athletes sharing a file and their zones bin it only once
+    tasks = [(filename, sorted(set(tuple(athlete.zones_edges) for athlete in file_athletes)))
+             for filename, file_athletes in athletes_of.items()]
+    totals = dict((athlete.name, {}) for athlete in athletes)
+    skipped = []
+    worker = partial(bin_file, cache=cache, time_weighted=time_weighted, max_gap=max_gap)
+    for (filename, _), result in zip(tasks, map_files(worker, tasks, jobs)):
+        if result is None:
+            skipped.append(filename)
+            continue
+        starts, counts = result
+        for athlete in athletes_of[filename]:
+            periods = totals[athlete.name]
+            for start, activity_counts in zip(starts, counts[tuple(athlete.zones_edges)]):
+                period = period_of(start, group)
+                periods[period] = periods.get(period, 0) + activity_counts
+    grouped = OrderedDict()
+    for athlete in athletes:
+        for period in sorted(totals[athlete.name]):
+            grouped[(athlete.name, period)] = totals[athlete.name][period]
+    return grouped, skipped
+
+
+# Parsing command line arguments
+parser = ArgumentParser(description="Output the zone distributions of every athlete of a manifest, each with their own zones, in one run", add_help=False)
+parser.add_argument('-h', '--help', action='help', default=SUPPRESS, help='show this help message and exit')
+parser.add_argument("manifest", help="A CSV or JSON file listing every athlete's zones and TCX files (glob patterns)")
+parser.add_argument("-g", "--group", choices=GROUPS, default=None, help="Print a distribution per athlete and week or month (UTC) instead of one per athlete")
+parser.add_argument("-c", "--columns", action="store_true", default=False, help="Print column headers in output")
+parser.add_argument("-v", "--verbose", action="count", default=0, help="Turn on verbose output")
+parser.add_argument("-j", "--jobs", type=jobs_number, default=1, help="Process files in parallel with JOBS processes (0 for one per CPU)")
+parser.add_argument("-w", "--time-weighted", action="store_true", default=False, help="Weight every heart rate sample by the time to the next Trackpoint, instead of counting samples")
+parser.add_argument("--max-gap", type=float, default=DEFAULT_MAX_GAP, help="With --time-weighted, count gaps between Trackpoints up to MAX_GAP seconds (default: {0})".format(DEFAULT_MAX_GAP))
+add_cache_arguments(parser)
+
+
+# main loop
+if __name__ == "__main__":
+    args = parser.parse_args()
+    try:
+        athletes = read_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        parser.error("cannot use manifest {0}: {1}".format(args.manifest, e))
+
+    cache = cache_from_args(args)
+    grouped, skipped = batch_zone_counts(athletes, args.group, args.jobs, cache, args.time_weighted, args.max_gap)
+    if cache:
+        evict(cache.directory, cache.max_bytes)
+
+    if args.verbose > 0:
+        files = set(filename for athlete in athletes for filename in athlete.files)
+        print("Athletes:        {0:5d}".format(len(athletes)))
+        print("Original files:  {0:5d}".format(len(files)))
+        print("Processed files: {0:5d}".format(len(files) - len(skipped)))
+        print("Skipped files:   {0:5d}".format(len(skipped)))
+
+    # One row per athlete, period and zone: athletes do not have the same number of zones.
+    # Athletes without any usable activity keep their rows, with empty frequencies
+    writer = csv.writer(sys.stdout, lineterminator="\n")
+    if args.columns:
+        writer.writerow(["athlete", "period", "zone", "frequency"])
+    for athlete in athletes:
+        periods = [(period, counts) for (name, period), counts in grouped.items() if name == athlete.name]
+        if not periods:
+            print(athlete.name, "has no usable activities", file=sys.stderr)
+            periods = [(ALL_PERIODS, None)]
+        for period, counts in periods:
+            frequencies = [""] * (len(athlete.zones_edges) - 1) if counts is None else \
+                          [repr(float(f)) for f in normed_rows(counts[np.newaxis].astype(np.float64))[0]]
+            for zone, frequency in zip(create_zones_names(athlete.zones_edges), frequencies):
+                writer.writerow([athlete.name, period, zone, frequency])
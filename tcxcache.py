@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# tcxcache.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# tcxcache.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tcxcache.py. If not, see http://www.gnu.org/licenses/.
+
+"""Opt-in on-disk cache of the trackpoint columns extracted from TCX files.
+
+Every entry is a directory named after a hash of the file's absolute path, size and
+modification time. It holds one .npy file per column, loaded memory-mapped, and a
+JSON file with the lap and activity summaries. A warm entry never touches the XML.
+The least recently used entries are evicted once the cache grows past its size limit."""
+
+import os, json, shutil, hashlib, tempfile
+from collections import namedtuple
+import numpy as np
+from tcxreader import FileColumns, LapSummary, ActivitySummary, read_columns
+from tcxprofile import stage
+
+# CONSTANTS
+COLUMNS = ["lap_offsets", "time", "bpm", "distance", "lat", "lon"]
+META_FILE = "meta.json"
+DEFAULT_CACHE_SIZE_MB = 1024
+MB = 1024 * 1024
+
+# The cache configuration passed to load_columns, None when caching is off
+CacheSettings = namedtuple("CacheSettings", ["directory", "max_bytes", "rebuild"])
+
+
+def add_cache_arguments(group):
+    """Add the cache options to an argparse argument group"""
+    group.add_argument("--cache-dir", default=os.environ.get("TCX_CACHE_DIR"), help="Cache parsed trackpoints in CACHE_DIR (default: $TCX_CACHE_DIR, if set)")
+    group.add_argument("--cache-size", type=float, default=DEFAULT_CACHE_SIZE_MB, help="Evict least recently used cache entries beyond CACHE_SIZE MB (default: {0})".format(DEFAULT_CACHE_SIZE_MB))
+    group.add_argument("--no-cache", action="store_true", default=False, help="Do not read nor write the cache")
+    group.add_argument("--rebuild-cache", action="store_true", default=False, help="Re-parse all files and overwrite their cache entries")
+
+def cache_from_args(args):
+    """Return the CacheSettings selected on the command line, or None if caching is off"""
+    if args.no_cache or not args.cache_dir:
+        return None
+    return CacheSettings(args.cache_dir, int(args.cache_size * MB), args.rebuild_cache)
+
+def cache_key(filename):
+    """Return the cache key of a file: a hash of its absolute path, size and modification time"""
+    stat = os.stat(filename)
+    key = "{0}\0{1}\0{2}".format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def _entry_size(entry):
+    """Return the total size in bytes of a cache entry"""
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+def _read_entry(entry):
+    """Load a cache entry as FileColumns, with memory-mapped columns"""
+    with open(os.path.join(entry, META_FILE)) as meta_file:
+        meta = json.load(meta_file)
+    columns = dict((name, np.load(os.path.join(entry, name + ".npy"), mmap_mode="r")) for name in COLUMNS)
+    return FileColumns([LapSummary(*lap) for lap in meta["laps"]],
+                       [ActivitySummary(*activity) for activity in meta["activities"]],
+                       **columns)
+
+def _write_entry(entry, filename, columns):
+    """Store FileColumns in a cache entry. The entry appears atomically, or not at all"""
+    directory = os.path.dirname(entry)
+    tmp_entry = tempfile.mkdtemp(prefix=".tmp", dir=directory)
+    try:
+        for name in COLUMNS:
+            np.save(os.path.join(tmp_entry, name + ".npy"), getattr(columns, name))
+        with open(os.path.join(tmp_entry, META_FILE), "w") as meta_file:
+            json.dump({"source": os.path.abspath(filename),
+                       "laps": [list(lap) for lap in columns.laps],
+                       "activities": [list(activity) for activity in columns.activities]}, meta_file)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # Another process won the race for this entry, or the disk is full: the cache is only an optimization
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+def evict(directory, max_bytes):
+    """Delete the least recently used entries until the cache fits in max_bytes.
+       Scanning the whole cache is not free: call once per run, not once per file."""
+    if not os.path.isdir(directory):
+        return
+    entries = []
+    for name in os.listdir(directory):
+        entry = os.path.join(directory, name)
+        if name.startswith(".") or not os.path.isdir(entry):
+            continue
+        try:
+            entries.append((os.path.getmtime(os.path.join(entry, META_FILE)), _entry_size(entry), entry))
+        except OSError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+def load_columns(filename, cache=None):
+    """Return the FileColumns of a TCX file, from the cache when possible.
+       Parse the file, and store it in the cache if one is configured, otherwise."""
+    if cache is None:
+        with open(filename, "rb") as tcx_file:
+            return read_columns(tcx_file)
+    entry = os.path.join(cache.directory, cache_key(filename))
+    if not cache.rebuild and os.path.isdir(entry):
+        try:
+            columns = _read_entry(entry)
+            # Touching the metadata file marks the entry as recently used
+            os.utime(os.path.join(entry, META_FILE), None)
+            stage("read").add("cache hits")
+            return columns
+        except (OSError, ValueError, TypeError, KeyError):
+            pass    # a damaged entry is simply rebuilt
+    with open(filename, "rb") as tcx_file:
+        columns = read_columns(tcx_file)
+    if not os.path.isdir(cache.directory):
+        os.makedirs(cache.directory, exist_ok=True)
+    _write_entry(entry, filename, columns)
+    return columns
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# tcxexport.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# tcxexport.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tcxexport.py. If not, see http://www.gnu.org/licenses/.
+
+"""Export lap summaries, zone distributions and trackpoints as typed Parquet or Arrow files.
+
+Every dataset (laps, curves, zones, trackpoints) is a directory of hive-style partitions,
+EXPORT_DIR/dataset/date=2020-01-05/ or EXPORT_DIR/dataset/activity=.../, holding one file
+per TCX file. Files are named after their TCX file, so exporting a file again replaces its data,
+and any Parquet/Arrow reader can load a dataset with its partition column.
+Needs the pyarrow package; the CSV output of the scripts does not."""
+
+import os, re, hashlib
+from collections import namedtuple
+from importlib.util import find_spec
+import numpy as np
+
+# pyarrow is imported by the first export (see _import_pyarrow): csv runs never load it
+HAS_PYARROW = find_spec("pyarrow") is not None
+pa = pq = None
+
+# CONSTANTS
+FORMATS = ["csv", "parquet", "arrow"]
+PARTITIONS = ["date", "activity"]
+EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow"}
+INTEGER_COLUMNS = ["# Trackpoints", "Total time"]
+
+# The export configuration passed to the workers, None when the output is csv
+ExportSettings = namedtuple("ExportSettings", ["directory", "format", "partition", "trackpoints"])
+
+
+def add_export_arguments(group):
+    """Add the export options to an argparse argument group"""
+    group.add_argument("--output-format", choices=FORMATS, default="csv", help="Write results as csv on the standard output (default), or as Parquet or Arrow files in EXPORT_DIR (needs pyarrow)")
+    group.add_argument("--export-dir", default=None, help="With --output-format parquet or arrow, the directory of the exported datasets")
+    group.add_argument("--partition", choices=PARTITIONS, default="date", help="Partition exported datasets by activity date (default) or by activity")
+    group.add_argument("--export-trackpoints", action="store_true", default=False, help="Also export the trackpoints of every lap")
+
+def export_from_args(args, parser):
+    """Return the ExportSettings selected on the command line, or None for csv output.
+       Exit through parser.error if they cannot be honored"""
+    if args.output_format == "csv":
+        return None
+    if not HAS_PYARROW:
+        parser.error("pyarrow package not installed. Cannot use --output-format {0}".format(args.output_format))
+    if not args.export_dir:
+        parser.error("--output-format {0} needs --export-dir".format(args.output_format))
+    return ExportSettings(args.export_dir, args.output_format, args.partition, args.export_trackpoints)
+
+def _import_pyarrow():
+    """Import pyarrow and pyarrow.parquet as the module's pa and pq, once"""
+    global pa, pq
+    if pa is None:
+        import pyarrow
+        import pyarrow.parquet
+        pa, pq = pyarrow, pyarrow.parquet
+
+def _safe(value):
+    """Turn a partition value (a date or an activity Id) into a portable directory name"""
+    return re.sub(r"[^0-9A-Za-z._-]", "-", str(value))
+
+def _part_name(filename):
+    """Return the name of the files exported for a TCX file: its name plus a hash of its path,
+       so that files with the same name in different directories do not overwrite each other"""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return "{0}-{1}".format(_safe(stem), hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()[:8])
+
+def partition_key(activity_id, start_time, partition):
+    """Return the partition value of an activity or lap: its (UTC) date, or its activity Id"""
+    if partition == "activity":
+        return _safe(activity_id)
+    return (start_time or activity_id or "unknown")[:10]
+
+def write_dataset(export, dataset, filename, table, keys):
+    """Write a table to the dataset's partitions, one file per partition value found in keys (one per row)"""
+    keys = np.asarray(keys, dtype=object)
+    for key in sorted(set(keys)):
+        directory = os.path.join(export.directory, dataset, "{0}={1}".format(export.partition, key))
+        os.makedirs(directory, exist_ok=True)
+        part = table.filter(pa.array(keys == key)) if len(set(keys)) > 1 else table
+        path = os.path.join(directory, _part_name(filename) + EXTENSIONS[export.format])
+        if export.format == "parquet":
+            pq.write_table(part, path)
+        else:
+            with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, part.schema) as writer:
+                writer.write_table(part)
+
+def _timestamps(epoch_ns):
+    """Convert epoch nanoseconds (NAT for missing) into an Arrow UTC timestamp array"""
+    epoch_ns = np.asarray(epoch_ns, dtype=np.int64)
+    return pa.array(epoch_ns.view("datetime64[ns]"), type=pa.timestamp("ns", tz="UTC"))
+
+def _floats(values):
+    """Convert values, possibly None or missing, into an Arrow float64 array with nulls"""
+    return pa.array([None if value is None or value != value else float(value) for value in values], type=pa.float64())
+
+def trackpoints_table(laps):
+    """Return the trackpoints of a list of Lap records as an Arrow table, with the lap number of every trackpoint"""
+    _import_pyarrow()
+    counts = [len(lap.time) for lap in laps]
+    def column(name):
+        return np.concatenate([getattr(lap, name) for lap in laps]) if laps else np.zeros(0)
+    lat, lon = column("lat").astype(np.float64), column("lon").astype(np.float64)
+    return pa.table({"Lap": pa.array(np.repeat(np.arange(len(laps), dtype=np.int32), counts)),
+                     "Time": _timestamps(column("time")),
+                     "Bpm": pa.array(column("bpm")),
+                     "Distance": pa.array(column("distance").astype(np.float32)),
+                     "Latitude": pa.array(lat, mask=np.isnan(lat)),
+                     "Longitude": pa.array(lon, mask=np.isnan(lon))})
+
+def export_trackpoints(export, filename, laps):
+    """Export the trackpoints of a file's Lap records, partitioned as their laps"""
+    keys = [partition_key(lap.summary.activity_id, lap.summary.start_time, export.partition) for lap in laps]
+    table = trackpoints_table(laps)
+    write_dataset(export, "trackpoints", filename, table, np.repeat(np.array(keys, dtype=object), [len(lap.time) for lap in laps]))
+
+def export_laps(export, filename, laps_rows, laps, lap_columns):
+    """Export a file's lap rows, as returned by tcxlib.parse_laps for the Lap records laps.
+       Times are UTC timestamps, local beginning and end times are kept as text; pace strings are left out"""
+    _import_pyarrow()
+    columns = {"Filename": pa.array([os.path.basename(filename)] * len(laps), type=pa.string()),
+               "Lap": pa.array(np.arange(len(laps), dtype=np.int32)),
+               "Activity": pa.array([lap.summary.activity_id for lap in laps], type=pa.string()),
+               "Sport": pa.array([lap.summary.sport for lap in laps], type=pa.string()),
+               "Beginning time (UTC)": _timestamps([lap.time[0] for lap in laps]),
+               "End time (UTC)": _timestamps([lap.time[-1] for lap in laps]),
+               "Beginning time": pa.array([str(row["Beginning time"]) for row in laps_rows], type=pa.string()),
+               "End time": pa.array([str(row["End time"]) for row in laps_rows], type=pa.string())}
+    for name in lap_columns:
+        if name in columns or name in ("Filename", "Duration", "Halftime") or "pace" in name.lower():
+            continue
+        values = [row.get(name) for row in laps_rows]
+        columns[name] = pa.array(values, type=pa.int64()) if name in INTEGER_COLUMNS else _floats(values)
+    columns["Duration (s)"] = pa.array([(int(lap.time[-1]) - int(lap.time[0])) / 1e9 for lap in laps], type=pa.float64())
+    keys = [partition_key(lap.summary.activity_id, lap.summary.start_time, export.partition) for lap in laps]
+    write_dataset(export, "laps", filename, pa.table(columns), keys)
+
+def export_curves(export, filename, curves, laps):
+    """Export a file's drift curves table, as returned by tcxlib.drift_curves for the Lap records laps"""
+    _import_pyarrow()
+    columns = {"Lap": pa.array(np.asarray(curves["lap"], dtype=np.int32))}
+    columns.update((name, pa.array(values)) for name, values in curves.items() if name not in ("lap", "Filename"))
+    keys = [partition_key(lap.summary.activity_id, lap.summary.start_time, export.partition) for lap in laps]
+    write_dataset(export, "curves", filename, pa.table(columns), np.array(keys, dtype=object)[np.asarray(curves["lap"], dtype=np.int64)])
+
+def export_zones(export, filename, details, activities_counts, zones_names):
+    """Export a file's per-activity zone counts and frequencies, as returned by tcxlib.file_zone_counts"""
+    _import_pyarrow()
+    activities_counts = np.asarray(activities_counts)
+    totals = activities_counts.sum(axis=1)
+    columns = {"Filename": pa.array([os.path.basename(filename)] * len(activities_counts), type=pa.string()),
+               "Activity": pa.array(details["activities"], type=pa.string()),
+               "Sport": pa.array(details["sports"], type=pa.string())}
+    for i, name in enumerate(zones_names):
+        columns[name] = pa.array(activities_counts[:, i])
+    for i, name in enumerate(zones_names):
+        columns[name + " frequency"] = pa.array(activities_counts[:, i] / np.where(totals > 0, totals, 1))
+    keys = [partition_key(activity, None, export.partition) for activity in details["activities"]]
+    write_dataset(export, "zones", filename, pa.table(columns), keys)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# tcxindex.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# tcxindex.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tcxindex.py. If not, see http://www.gnu.org/licenses/.
+
+"""A SQLite index of TCX activities, ingested incrementally and queried without reading any TCX file.
+
+For every file the index records its size and modification time, its activities (date, sport,
+total time and distance), the heart rate histogram of every activity (samples and seconds at
+every BPM value) and tcxaet's lap summaries. Ingesting a directory again only reads the files
+that are new or changed. Zone distributions for any zones are summed from the histograms.
+
+Usage: tcxindex.py ingest [-j JOBS] [--prune] FILE_OR_DIR...
+       tcxindex.py zones -z ZONES [-w] [-c] [--sport SPORT] [--month YYYY-MM | --from DATE --to DATE]
+       tcxindex.py laps [-c] [--sport SPORT] [--month YYYY-MM | --from DATE --to DATE]"""
+
+from __future__ import print_function
+import sys, os, csv, sqlite3
+from argparse import ArgumentParser, ArgumentTypeError, SUPPRESS
+from functools import partial
+import numpy as np
+from tcxreader import NAT, file_laps, activity_offsets, activity_start_times
+from tcxlib import (DEFAULT_MAX_GAP, HAS_TIMEZONEFINDER, load_source, sample_weights, parse_tcx_lap, parse_laps,
+                    validate_zones_list, create_zones_names, zone_indices, normed_rows)
+from tcxcache import add_cache_arguments, cache_from_args, evict
+from tcxpool import map_files, jobs_number
+
+# CONSTANTS
+SCHEMA_VERSION = 3
+TCX_EXTENSIONS = (".tcx",)
+# tcxaet's lap row columns stored in the laps table, and their SQL names
+LAP_FIELDS = [("Total distance", "total_distance"), ("# Trackpoints", "trackpoints"), ("Total time", "total_time"),
+              ("Avg. BPM", "avg_bpm"), ("Speed (m/s)", "speed"),
+              ("1st half avg. BPM", "first_half_avg_bpm"), ("2nd half avg. BPM", "second_half_avg_bpm"),
+              ("1st half speed (m/s)", "first_half_speed"), ("2nd half speed (m/s)", "second_half_speed"),
+              ("1st/2nd half drift", "drift"), ("1st/2nd hald BPM-only drift", "bpm_only_drift")]
+INTEGER_FIELDS = ["trackpoints", "total_time"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, size INTEGER, mtime_ns INTEGER, max_gap REAL, error TEXT);
+CREATE TABLE IF NOT EXISTS activities (
+    id INTEGER PRIMARY KEY, file INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    activity_id TEXT, sport TEXT, start_time TEXT, total_time_seconds REAL, total_distance_meters REAL,
+    laps INTEGER, trackpoints INTEGER);
+CREATE INDEX IF NOT EXISTS activities_by_start ON activities (start_time);
+CREATE INDEX IF NOT EXISTS activities_by_file ON activities (file);
+CREATE TABLE IF NOT EXISTS heart_rates (
+    activity INTEGER NOT NULL REFERENCES activities(id) ON DELETE CASCADE,
+    bpm INTEGER NOT NULL, samples INTEGER, seconds REAL, PRIMARY KEY (activity, bpm)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS laps (
+    id INTEGER PRIMARY KEY, activity INTEGER NOT NULL REFERENCES activities(id) ON DELETE CASCADE,
+    lap INTEGER, start_time TEXT, beginning_time TEXT, end_time TEXT, duration REAL, {0});
+CREATE INDEX IF NOT EXISTS laps_by_activity ON laps (activity);
+CREATE INDEX IF NOT EXISTS laps_by_start ON laps (start_time);
+""".format(", ".join(name + (" INTEGER" if name in INTEGER_FIELDS else " REAL") for _, name in LAP_FIELDS))
+
+
+# THE INDEX
+def connect(filename):
+    """Open (or create) the index in filename and return the sqlite3 connection"""
+    connection = sqlite3.connect(filename)
+    connection.execute("PRAGMA foreign_keys = ON")
+    # Every ingested file is committed on its own: with a write-ahead log, commits do not wait for the disk
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.executescript(SCHEMA)
+    if _meta(connection, "schema_version", str(SCHEMA_VERSION)) != str(SCHEMA_VERSION):
+        # An index of an older layout is rebuilt: the next ingest reads every file again
+        connection.executescript("DROP TABLE laps; DROP TABLE heart_rates; DROP TABLE activities; DROP TABLE files; DELETE FROM meta;")
+        connection.executescript(SCHEMA)
+    connection.execute("INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),))
+    return connection
+
+def _meta(connection, key, default=None):
+    """Return a value of the meta table"""
+    row = connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def find_tcx_files(paths):
+    """Expand a list of files and directories into the TCX files they contain, directories recursively"""
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                for name in sorted(names):
+                    if name.lower().endswith(TCX_EXTENSIONS):
+                        yield os.path.join(directory, name)
+        else:
+            yield path
+
+def _iso(epoch_ns):
+    """Format epoch nanoseconds as an ISO UTC time, the format of the index' start times"""
+    return str(np.datetime64(int(epoch_ns), "ns").astype("datetime64[ms]")) + "Z"
+
+def _column_value(name, value):
+    """Convert a lap row value for its laps column. Missing and non-finite values are stored as NULL,
+       which COUNT and TOTAL leave out"""
+    if value is None or not np.isfinite(value):
+        return None
+    return int(value) if name in INTEGER_FIELDS else float(value)
+
+def file_records(filename, cache=None, max_gap=DEFAULT_MAX_GAP, local_time=True):
+    """Extract everything the index stores about a TCX file (a worker for the -j/--jobs process pool).
+       Return a dictionary of the file's activities, heart rate histograms and lap rows,
+       with an error message instead if the file cannot be read"""
+    try:
+        stat = os.stat(filename)
+    except OSError as e:
+        print(filename, "does not exist in filesystem. Skipping", file=sys.stderr)
+        return {"path": os.path.abspath(filename), "size": None, "mtime_ns": None, "max_gap": float(max_gap), "error": str(e)}
+    try:
+        columns = load_source(filename, cache)
+    except Exception as e:
+        # Remembered with its size and time, so that it is not read again until it changes
+        print(filename, " is not a valid TCX file. Skipping", file=sys.stderr)
+        return {"path": os.path.abspath(filename), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "max_gap": float(max_gap),
+                "error": str(e)}
+    offsets = activity_offsets(columns)
+    starts = activity_start_times(columns)
+    activities = []
+    for i, activity in enumerate(columns.activities):
+        start_time = _iso(starts[i]) if starts[i] != NAT else activity.activity_id
+        activities.append((activity.activity_id, activity.sport, start_time, activity.total_time_seconds,
+                           activity.total_distance_meters, activity.laps, int(offsets[i + 1] - offsets[i])))
+    # One histogram bin per BPM value and activity: any zones can be summed from it later
+    activity_of = np.repeat(np.arange(len(columns.activities)), np.diff(offsets))
+    bpm = np.asarray(columns.bpm, dtype=np.int64)
+    recorded = bpm > 0
+    width = int(bpm.max()) + 1 if len(bpm) else 1
+    bins = activity_of[recorded] * width + bpm[recorded]
+    samples = np.bincount(bins, minlength=len(columns.activities) * width)
+    seconds = np.bincount(bins, weights=sample_weights(columns, offsets, max_gap)[recorded], minlength=len(samples))
+    heart_rates = [(int(b) // width, int(b) % width, int(samples[b]), float(seconds[b])) for b in np.flatnonzero(samples)]
+    # tcxaet's lap rows; laps without usable trackpoints are left out, as tcxaet does
+    lap_activities = np.repeat(np.arange(len(columns.activities)), [a.laps for a in columns.activities])
+    laps = [(int(lap_activities[i]), i, lap) for i, lap in enumerate(file_laps(columns)) if len(lap.time)]
+    rows = parse_laps(parse_tcx_lap((os.path.basename(filename), lap) for _, _, lap in laps), local_time=local_time)
+    lap_records = []
+    for (activity, i, lap), row in zip(laps, rows):
+        lap_records.append((activity, i, _iso(lap.time[0]), str(row["Beginning time"]), str(row["End time"]),
+                            (int(lap.time[-1]) - int(lap.time[0])) / 1e9)
+                           + tuple(_column_value(name, row.get(key)) for key, name in LAP_FIELDS))
+    return {"path": os.path.abspath(filename), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "max_gap": float(max_gap),
+            "activities": activities, "heart_rates": heart_rates, "laps": lap_records}
+
+def store(connection, records):
+    """Replace a file's rows in the index with the records returned by file_records"""
+    connection.execute("DELETE FROM files WHERE path = ?", (records["path"],))
+    if "error" in records:
+        connection.execute("INSERT INTO files (path, size, mtime_ns, max_gap, error) VALUES (?, ?, ?, ?, ?)",
+                           (records["path"], records["size"], records["mtime_ns"], records["max_gap"], records["error"]))
+        return
+    file_id = connection.execute("INSERT INTO files (path, size, mtime_ns, max_gap) VALUES (?, ?, ?, ?)",
+                                 (records["path"], records["size"], records["mtime_ns"], records["max_gap"])).lastrowid
+    activity_ids = []
+    for activity in records["activities"]:
+        activity_ids.append(connection.execute(
+            "INSERT INTO activities (file, activity_id, sport, start_time, total_time_seconds, total_distance_meters, laps, trackpoints)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (file_id,) + tuple(activity)).lastrowid)
+    connection.executemany("INSERT INTO heart_rates VALUES (?, ?, ?, ?)",
+                           [(activity_ids[a], bpm, samples, seconds) for a, bpm, samples, seconds in records["heart_rates"]])
+    connection.executemany("INSERT INTO laps (activity, lap, start_time, beginning_time, end_time, duration, {0})"
+                           " VALUES ({1})".format(", ".join(name for _, name in LAP_FIELDS), ", ".join(["?"] * (6 + len(LAP_FIELDS)))),
+                           [(activity_ids[lap[0]],) + tuple(lap[1:]) for lap in records["laps"]])
+
+def _is_current(known, filename, max_gap=DEFAULT_MAX_GAP):
+    """Return True if the index holds filename at its current size and modification time, read with max_gap"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return False
+    return known.get(os.path.abspath(filename)) == (stat.st_size, stat.st_mtime_ns, float(max_gap))
+
+def ingest(connection, paths, jobs=1, cache=None, max_gap=DEFAULT_MAX_GAP, local_time=True, prune=False, aggregates=None,
+           directories=None):
+    """Index the TCX files in paths (files or directories) that are new or changed since the last ingest.
+       Files indexed with a different max_gap count as changed. With prune, forget the
+       indexed files that no longer exist (only those in directories, if given). aggregates, if given, is told of every replaced or forgotten
+       file by calling aggregates.update(connection, path, -1) before and (connection, path, 1) after.
+       Return a dictionary with the numbers of ingested, unchanged, skipped and pruned files"""
+    known = dict((path, (size, mtime_ns, gap)) for path, size, mtime_ns, gap
+                 in connection.execute("SELECT path, size, mtime_ns, max_gap FROM files"))
+    filenames = list(find_tcx_files(paths))
+    changed = [filename for filename in filenames if not _is_current(known, filename, max_gap)]
+    counts = {"ingested": 0, "unchanged": len(filenames) - len(changed), "skipped": 0, "pruned": 0}
+    worker = partial(file_records, cache=cache, max_gap=max_gap, local_time=local_time)
+    for records in map_files(worker, changed, jobs):
+        with connection:
+            if aggregates:
+                aggregates.update(connection, records["path"], -1)
+            store(connection, records)
+            if aggregates:
+                aggregates.update(connection, records["path"], 1)
+        counts["skipped" if "error" in records else "ingested"] += 1
+    if prune:
+        prefixes = tuple(os.path.join(os.path.abspath(directory), "") for directory in directories) if directories else ("",)
+        with connection:
+            for path in known:
+                if path.startswith(prefixes) and not os.path.exists(path):
+                    if aggregates:
+                        aggregates.update(connection, path, -1)
+                    connection.execute("DELETE FROM files WHERE path = ?", (path,))
+                    counts["pruned"] += 1
+    return counts
+
+def _activity_filter(sport=None, start=None, end=None, directories=None):
+    """Return the SQL condition and parameters selecting activities by sport, [start, end) dates
+       and, if given, the directories their files are in"""
+    conditions, parameters = ["1"], []
+    if directories:
+        prefixes = [os.path.join(os.path.abspath(directory), "") for directory in directories]
+        conditions.append("a.file IN (SELECT id FROM files WHERE {0})".format(" OR ".join(["substr(path, 1, ?) = ?"] * len(prefixes))))
+        for prefix in prefixes:
+            parameters.extend([len(prefix), prefix])
+    if sport:
+        conditions.append("a.sport = ? COLLATE NOCASE")
+        parameters.append(sport)
+    if start:
+        conditions.append("a.start_time >= ?")
+        parameters.append(start)
+    if end:
+        conditions.append("a.start_time < ?")
+        parameters.append(end)
+    return " AND ".join(conditions), parameters
+
+def zone_counts(connection, zones_edges, sport=None, start=None, end=None, time_weighted=False):
+    """Return the zone counts (samples, or seconds if time_weighted) of the indexed activities
+       of a sport started in [start, end), summed from their heart rate histograms"""
+    condition, parameters = _activity_filter(sport, start, end)
+    rows = connection.execute("SELECT h.bpm, SUM(h.{0}) FROM heart_rates h JOIN activities a ON a.id = h.activity"
+                              " WHERE {1} GROUP BY h.bpm".format("seconds" if time_weighted else "samples", condition),
+                              parameters).fetchall()
+    bpm = np.array([row[0] for row in rows], dtype=np.int64)
+    weights = np.array([row[1] for row in rows], dtype=np.float64)
+    indices = zone_indices(bpm, zones_edges)
+    counts = np.bincount(indices[indices >= 0], weights=weights[indices >= 0], minlength=len(zones_edges) - 1)
+    return counts if time_weighted else counts.astype(np.int64)
+
+def file_totals(connection, path=None, sport=None, directories=None):
+    """Return the heart rate histogram (bpm, samples and seconds arrays), the numbers of activities and laps,
+       and the numbers and sums of the laps' drifts of the indexed activities of a sport in the file path
+       (all files if None, or all files in directories if given)"""
+    condition, parameters = _activity_filter(sport, directories=directories)
+    if path is not None:
+        condition += " AND a.file = (SELECT id FROM files WHERE path = ?)"
+        parameters.append(path)
+    rows = connection.execute("SELECT h.bpm, SUM(h.samples), SUM(h.seconds) FROM heart_rates h JOIN activities a ON a.id = h.activity"
+                              " WHERE {0} GROUP BY h.bpm".format(condition), parameters).fetchall()
+    activities, = connection.execute("SELECT COUNT(*) FROM activities a WHERE {0}".format(condition), parameters).fetchone()
+    laps, drift_laps, drift, bpm_only_drift_laps, bpm_only_drift = connection.execute(
+        "SELECT COUNT(*), COUNT(l.drift), TOTAL(l.drift), COUNT(l.bpm_only_drift), TOTAL(l.bpm_only_drift) FROM laps l JOIN activities a ON a.id = l.activity"
+        " WHERE {0}".format(condition), parameters).fetchone()
+    return {"bpm": np.array([row[0] for row in rows], dtype=np.int64),
+            "samples": np.array([row[1] for row in rows], dtype=np.int64),
+            "seconds": np.array([row[2] for row in rows], dtype=np.float64),
+            "activities": activities, "laps": laps, "drift_laps": drift_laps, "drift": drift,
+            "bpm_only_drift_laps": bpm_only_drift_laps, "bpm_only_drift": bpm_only_drift}
+
+def lap_rows(connection, sport=None, start=None, end=None, latest=None, directories=None):
+    """Return the indexed lap summaries of the activities of a sport started in [start, end)
+       (of the files in directories if given), only the latest ones if given a number,
+       as a list of dictionaries, oldest first"""
+    condition, parameters = _activity_filter(sport, start, end, directories)
+    order = "l.start_time, f.path, l.lap"
+    if latest is not None:
+        order = "l.start_time DESC, f.path DESC, l.lap DESC LIMIT {0:d}".format(latest)
+    cursor = connection.execute("SELECT f.path, a.activity_id, a.sport, l.lap, l.start_time, l.beginning_time, l.end_time,"
+                                " l.duration, {0} FROM laps l JOIN activities a ON a.id = l.activity JOIN files f ON f.id = a.file"
+                                " WHERE {1} ORDER BY {2}".format(", ".join("l." + name for _, name in LAP_FIELDS), condition, order),
+                                parameters)
+    names = [description[0] for description in cursor.description]
+    rows = [dict(zip(names, row)) for row in cursor]
+    return rows[::-1] if latest is not None else rows
+
+
+# COMMAND LINE
+def month(value):
+    """Parse a --month argument, YYYY-MM or YYYY-M, into YYYY-MM"""
+    parts = value.split("-")
+    try:
+        year, month_number = [int(part) for part in parts] if len(parts) == 2 else (0, 0)
+    except ValueError:
+        year = month_number = 0
+    if not (1 <= year <= 9999 and 1 <= month_number <= 12):
+        raise ArgumentTypeError("not a month in the form YYYY-MM: {0}".format(value))
+    return "{0:04d}-{1:02d}".format(year, month_number)
+
+def date_range(args):
+    """Return the [start, end) dates selected by --month or --from/--to, as ISO strings"""
+    if args.month:
+        year, month = [int(part) for part in args.month.split("-")]
+        following = "{0:04d}-{1:02d}".format(year + month // 12, month % 12 + 1)
+        return args.month, following
+    return args.start, args.end
+
+parser = ArgumentParser(description="Index TCX activities incrementally in SQLite and query zone distributions and laps from the index", add_help=False)
+parser.add_argument('-h', '--help', action='help', default=SUPPRESS, help='show this help message and exit')
+parser.add_argument("-i", "--index", default=os.environ.get("TCX_INDEX", "tcxindex.db"), help="The index file (default: $TCX_INDEX, or tcxindex.db)")
+commands = parser.add_subparsers(dest="command")
+
+ingest_parser = commands.add_parser("ingest", help="Index new and changed TCX files")
+ingest_parser.add_argument("paths", nargs="+", help="TCX files and directories to search for TCX files")
+ingest_parser.add_argument("-j", "--jobs", type=jobs_number, default=1, help="Read files in parallel with JOBS processes (0 for one per CPU)")
+ingest_parser.add_argument("--max-gap", type=float, default=DEFAULT_MAX_GAP, help="Longest gap between Trackpoints counted in full by time-weighted distributions (default: {0})".format(DEFAULT_MAX_GAP))
+ingest_parser.add_argument("--utc", action="store_true", default=False, help="Store the laps' beginning and end times in UTC instead of local time")
+ingest_parser.add_argument("--prune", action="store_true", default=False, help="Forget indexed files that no longer exist")
+ingest_parser.add_argument("-v", "--verbose", action="count", default=0, help="Print the numbers of ingested, unchanged, skipped and pruned files")
+add_cache_arguments(ingest_parser)
+
+for name, description in [("zones", "Print the zone distribution of the indexed activities"),
+                          ("laps", "Print the lap summaries of the indexed activities")]:
+    query_parser = commands.add_parser(name, help=description)
+    query_parser.add_argument("--sport", default=None, help="Only activities of SPORT (e.g. Running, Biking)")
+    query_parser.add_argument("--month", type=month, default=None, help="Only activities started in MONTH (YYYY-MM, UTC)")
+    query_parser.add_argument("--from", dest="start", default=None, help="Only activities started on or after START (YYYY-MM-DD, UTC)")
+    query_parser.add_argument("--to", dest="end", default=None, help="Only activities started before END (YYYY-MM-DD, UTC)")
+    query_parser.add_argument("-c", "--columns", action="store_true", default=False, help="Print column headers in output")
+    if name == "zones":
+        query_parser.add_argument("-z", "--zones", required=True, help="A list of 2 or more numbers delimiting heart rate activity zones in the form 0, n, m, k")
+        query_parser.add_argument("-w", "--time-weighted", action="store_true", default=False, help="Count the seconds spent in every zone instead of samples")
+
+
+# main loop
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if not args.command:
+        parser.error("a command is needed: ingest, zones or laps")
+    if args.command != "ingest" and args.month and (args.start or args.end):
+        parser.error("--month cannot be used with --from or --to")
+    connection = connect(args.index)
+
+    if args.command == "ingest":
+        cache = cache_from_args(args)
+        counts = ingest(connection, args.paths, args.jobs, cache, args.max_gap,
+                        local_time=HAS_TIMEZONEFINDER and not args.utc, prune=args.prune)
+        if cache:
+            evict(cache.directory, cache.max_bytes)
+        if args.verbose > 0:
+            for key in ["ingested", "unchanged", "skipped", "pruned"]:
+                print("{0:<10} {1:5d}".format(key.capitalize() + ":", counts[key]))
+
+    elif args.command == "zones":
+        zones_edges = validate_zones_list(args.zones)
+        zones_names = create_zones_names(zones_edges)
+        start, end = date_range(args)
+        counts = zone_counts(connection, zones_edges, args.sport, start, end, args.time_weighted)
+        writer = csv.writer(sys.stdout, lineterminator="\n")
+        if args.columns:
+            writer.writerow(["zone", "frequency"])
+        for name, frequency in zip(zones_names, normed_rows(counts[np.newaxis].astype(np.float64))[0]):
+            writer.writerow([name, repr(float(frequency))])
+
+    else:
+        start, end = date_range(args)
+        rows = lap_rows(connection, args.sport, start, end)
+        writer = csv.writer(sys.stdout, lineterminator="\n")
+        if args.columns and rows:
+            writer.writerow(list(rows[0]))
+        for row in rows:
+            writer.writerow(list(row.values()))
+    connection.close()
@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# tcxlib.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# tcxlib.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tcxlib.py. If not, see http://www.gnu.org/licenses/.
+
+"""Heart rate zones and aerobic drift computations behind tcxzones.py and tcxaet.py.
+
+Importing this module parses no command line and does not import pandas. The two entry points,
+compute_zone_distribution and compute_aerobic_drift, accept TCX filenames, binary file objects
+or already extracted FileColumns, so they can be called many times from one process."""
+
+from __future__ import print_function
+import sys, re
+from ntpath import basename
+from datetime import datetime, timedelta, timezone
+from collections import namedtuple
+import numpy as np
+from tcxreader import NAT, Lap, FileColumns, recorded_values, read_columns, iter_lap_columns, file_laps, activity_offsets, file_heart_rates
+from tcxcache import load_columns
+from tcxprofile import stage
+
+from tcxtz import HAS_TIMEZONEFINDER, timezone_at, cache_stats
+
+# CONSTANTS
+METERS2MILES = 1609.34
+MIN2SECS = 60 # for clarity in formulas
+NANOSECONDS = 1e9
+DEFAULT_MAX_GAP = 30    # seconds, longest gap between Trackpoints counted in full by time-weighted distributions
+
+# The result of compute_zone_distribution. counts and frequencies are per zone; files lists the
+# (name, details, per-activity counts) of every processed file, skipped the (name, error) of the others
+ZoneDistribution = namedtuple("ZoneDistribution", ["names", "edges", "counts", "frequencies", "files", "skipped"])
+
+
+class NoHeartRateData(ValueError):
+    """Raised for TCX files without any heart rate sample"""
+
+
+# SOURCES
+def report_skipped(filename, error):
+    """Print on stderr why a file is skipped, given the exception raised while reading it"""
+    if isinstance(error, NoHeartRateData):
+        print(filename, " Does not contain usable heartrate data. Skipping", file=sys.stderr)
+    elif isinstance(error, FileNotFoundError):
+        print(filename, "does not exist in filesystem. Skipping", file=sys.stderr)
+    else:
+        print(filename, " is not a valid TCX file. Skipping", file=sys.stderr)
+        print(error, file=sys.stderr)
+
+def source_name(source):
+    """Return a printable name for a TCX source: a filename, a file object or FileColumns"""
+    if isinstance(source, FileColumns):
+        return "<columns>"
+    return getattr(source, "name", "<stream>") if hasattr(source, "read") else source
+
+def load_source(source, cache=None):
+    """Return the FileColumns of a TCX source: a filename (possibly cached), a binary file object or FileColumns"""
+    if isinstance(source, FileColumns):
+        return source
+    if hasattr(source, "read"):
+        return read_columns(source)
+    return load_columns(source, cache)
+
+
+# HEART RATE ZONES
+def validate_zones_list(a_list):
+    """Validate the zones list as a legal list of bin edges"""
+    try: 
+        zones_edges = [int(s) for s in re.findall(r'\b\d+\b', a_list)]
+    except Exception as e:
+          print(e, "All elements of zone list must be numbers")
+          sys.exit(1)
+    zones_edges=list(set(zones_edges))   # remove duplicates and turn back into list to allow sorting 
+    zones_edges.sort()
+    return zones_edges
+
+def create_zones_names(bin_edges_list):
+    """create n zone names for length of zones list - 1""" 
+    if len(bin_edges_list) < 2:
+        raise ValueError("The zones list must contain at least 2 unique values")
+        sys.exit(1)
+    else:
+        return ["Z"+ str(index[0]) for index in enumerate(bin_edges_list) if index[0] < len(bin_edges_list)-1]
+    
+def zone_indices(heart_rates, zones_edges):
+    """Return the zone index of every heart rate, -1 for rates outside all zones.
+       Zones are right-closed intervals, (edge[i], edge[i+1]], as in pandas' cut"""
+    indices = np.searchsorted(zones_edges, heart_rates, side="left") - 1
+    indices[indices >= len(zones_edges) - 1] = -1
+    return indices
+
+def bin_heart_rates(heart_rates, zones_edges):
+    """Bin an array of heart rates into zones. Return an array with the counts for each zone"""
+    indices = zone_indices(heart_rates, zones_edges)
+    return np.bincount(indices[indices >= 0], minlength=len(zones_edges) - 1)
+
+def sample_weights(columns, offsets, max_gap=DEFAULT_MAX_GAP):
+    """Return the time, in seconds, each trackpoint of a FileColumns record stands for: the time to the next
+       trackpoint of the same activity, capped at max_gap so that pauses and recording gaps do not count in full.
+       The last trackpoint of an activity, and trackpoints with no time, weigh nothing."""
+    time = np.asarray(columns.time)
+    weights = np.zeros(len(time))
+    if len(time) > 1:
+        weights[:-1] = np.diff(time) / NANOSECONDS
+        weights[:-1][(time[:-1] == NAT) | (time[1:] == NAT)] = 0.
+    weights[offsets[1:] - 1] = 0.
+    return np.clip(weights, 0., max_gap)
+
+def bin_activities(columns, zones_edges, time_weighted=False, max_gap=DEFAULT_MAX_GAP):
+    """Bin the heart rates of every activity in a FileColumns record.
+       Return a (number of activities, number of zones) array of counts: numbers of samples,
+       or seconds if time_weighted"""
+    zones_number = len(zones_edges) - 1
+    offsets = activity_offsets(columns)
+    activities = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    indices = zone_indices(columns.bpm, zones_edges)
+    # Missing heart rates are stored as 0 and must not fall into a zone starting below 0
+    in_zone = (indices >= 0) & (columns.bpm > 0)
+    weights = sample_weights(columns, offsets, max_gap)[in_zone] if time_weighted else None
+    counts = np.bincount(activities[in_zone] * zones_number + indices[in_zone], weights=weights, minlength=(len(offsets) - 1) * zones_number)
+    return counts.reshape(len(offsets) - 1, zones_number)
+
+def file_zone_counts(source, zones_edges, cache=None, time_weighted=False, max_gap=DEFAULT_MAX_GAP):
+    """Bin the heart rate data of a TCX source into zones.
+       Return a tuple (file details, per-activity zone counts). Raise NoHeartRateData if there is none"""
+    with stage("read") as current:
+        columns = load_source(source, cache)
+        current.add("files")
+        current.add("trackpoints", len(columns.time))
+    check_heart_rates(columns)
+    activities = columns.activities
+    # -d describes the file by its first activity's date and sport, and its first lap's time and distance
+    details = {"datetime": activities[0].activity_id,
+               "activity_type": activities[0].sport,
+               "total_time_seconds": columns.laps[0].total_time_seconds,
+               "total_distance_meters": columns.laps[0].distance_meters,
+               "activities": [a.activity_id for a in activities],
+               "sports": [a.sport for a in activities]}
+    with stage("bin") as current:
+        current.add("activities", len(activities))
+        return details, bin_activities(columns, zones_edges, time_weighted, max_gap)
+
+def check_heart_rates(columns):
+    """Raise NoHeartRateData if a FileColumns record has no heart rate sample"""
+    if len(file_heart_rates(columns)) == 0:
+        raise NoHeartRateData("No usable heart rate data")
+
+def normed_rows(counts):
+    """Normalize every row of a 2D array of zone counts to a unit vector"""
+    totals = counts.sum(axis=1, keepdims=True)
+    return counts / np.where(totals > 0, totals, 1)
+
+def compute_zone_distribution(files, edges, time_weighted=False, max_gap=DEFAULT_MAX_GAP, cache=None):
+    """Compute the distribution by zones of the heart rate data in a collection of TCX sources.
+       edges is a list of zone edges, or a string as accepted by validate_zones_list.
+       Files that cannot be used are reported in the result instead of raising. Return a ZoneDistribution"""
+    zones_edges = validate_zones_list(edges) if isinstance(edges, str) else sorted(set(edges))
+    zones_names = create_zones_names(zones_edges)
+    counts = np.zeros(len(zones_names), dtype=np.float64 if time_weighted else np.int64)
+    processed, skipped = [], []
+    for source in files:
+        try:
+            details, activities_counts = file_zone_counts(source, zones_edges, cache, time_weighted, max_gap)
+        except Exception as e:
+            skipped.append((source_name(source), e))
+            continue
+        counts += activities_counts.sum(axis=0)
+        processed.append((source_name(source), details, activities_counts))
+    return ZoneDistribution(zones_names, zones_edges, counts, normed_rows(counts[np.newaxis])[0], processed, skipped)
+
+
+# UNIT CONVERSIONS
+def UTC_datetime2local(datetime, coords, timezone=None):
+    """Convert TCX UTC's datetimes to local time, in the given timezone or in the one at coords"""
+
+    import pytz
+    timezone = timezone or timezone_at(coords)
+    datetime = pytz.utc.localize(datetime) #Garmin's TCX datetimes are always UTC, but only implicitly 
+    return datetime.astimezone(timezone) if timezone else datetime
+        
+def mil_min_val_to_mil_min_string(val):
+    """Convert a decimal miles/min value into a standard formatted string."""
+    if val == 0:
+        return "00:00"
+    else:
+        delta = timedelta(minutes=val)
+        l = str(delta).split(":")
+        return l[-2]+":"+str(round(float(l[-1]))).zfill(2)
+
+    
+def meter_sec_2_min_miles(n):
+    """Convert m/s speed into a minutes/mil pace value (i.e. decimal minutes) """
+    miles_a_minute = n/METERS2MILES*60
+    if miles_a_minute == 0:
+        return 0
+    else:
+        return  1/miles_a_minute
+    
+def min_miles2meter_sec(n):
+    """Convert decimal miles a minute pace into speed in m/s"""
+    secs_per_meter = n* 60 /METERS2MILES
+    return 1/secs_per_meter
+
+
+# AEROBIC DRIFT
+def read_tcx_files(sources, cache=None):
+    """ Stream all laps from a collection of TCX sources, one lap at a time. Files are streamed
+        straight from the XML unless a cache is given.
+        Yield tuples (filename, lap) where lap holds the lap's trackpoints as typed arrays"""
+    for source in sources:
+        stage("read").add("files")
+        lap_file = basename(source_name(source))
+        if isinstance(source, FileColumns) or cache:
+            for lap in file_laps(load_source(source, cache)):
+                yield (lap_file, lap)
+        elif hasattr(source, "read"):
+            for lap in iter_lap_columns(source):
+                yield (lap_file, lap)
+        else:
+            with open(source,"rb") as tcx_file:
+                for lap in iter_lap_columns(tcx_file):
+                    yield (lap_file, lap)
+
+def parse_tcx_lap(file_laps):
+    """ Parse TCX laps into dictionaries of relevant data.
+        Return list of dictionaries"""
+    laps=[]   
+    with stage("read") as current:
+        for (filename, lap) in file_laps:
+            current.add("laps")
+            current.add("trackpoints", len(lap.time))
+            if len(lap.time) == 0:
+                print("A lap in {} has no usable trackpoints. Skipping".format(filename), file=sys.stderr)
+                continue
+            laps.append(_lap_data(filename, lap))
+    return laps
+
+def _lap_data(filename, lap):
+    """Return the dictionary of a lap's data used by parse_laps"""
+    lap_data = {}
+    # Indoor activities may not record GPS coordinates, skip if missing
+    has_coords = ~(np.isnan(lap.lon) | np.isnan(lap.lat))
+    if has_coords.any():
+        first = has_coords.argmax()
+        lap_data['Lap_coords'] = (float(lap.lon[first]), float(lap.lat[first]))
+    else:
+        lap_data['Lap_coords'] = []
+        print("Lap description has no coordinates, and it may be an indoor activity. Cannot determine time zone and will use UTC time instead.", file=sys.stderr)
+        
+    lap_data['Filename']         = filename
+    lap_data['TotalTimeSeconds'] = int(lap.summary.total_time_seconds)
+    lap_data['Lap']              = lap
+    return lap_data
+
+def datetime64_2_datetime(aNumpyDaytime64):
+        """Convert a numpy datetime64 object into a regular pythone datetime"""
+        return aNumpyDaytime64.astype("datetime64[us]").astype(datetime)
+
+def epoch_ns_2_datetime64(ns):
+    """Convert an epoch nanoseconds integer into a numpy datetime64 object"""
+    return np.datetime64(int(ns), "ns")
+    
+def get_lap_times_and_duration(lap_data, local_time=True):
+    """Extract beginning time, end time, and duration from lap info and format appropriately.
+       Convert TCX's UTC time to lap's local time if passed long and lat coords.  
+       Return a tuple with the formatted info"""
+    
+    beginning_time = epoch_ns_2_datetime64(lap_data['Lap'].time[0])
+    end_time = epoch_ns_2_datetime64(lap_data['Lap'].time[-1])
+    if  lap_data['Lap_coords'] and local_time and HAS_TIMEZONEFINDER:
+        # The lap's time zone is resolved once, and memoized on its rounded coordinates
+        timezone = timezone_at(lap_data['Lap_coords'])
+        # numpy datetime64 is always UTC and does not know about timezones. 
+        # Need to convert to regular python datetime objects first
+        beginning_time = datetime64_2_datetime(beginning_time)
+        end_time = datetime64_2_datetime(end_time)
+        beginning_time = UTC_datetime2local(beginning_time, lap_data['Lap_coords'], timezone) 
+        end_time = UTC_datetime2local(end_time, lap_data['Lap_coords'], timezone) 
+    duration = end_time - beginning_time
+    return (beginning_time, end_time, duration)
+
+def lap_halftime_value(lap):
+    """Return the time (as epoch nanoseconds) corresponding to the half point of the lap."""
+
+    time = lap['Lap'].time
+    return time.min() + (time.max() - time.min()) // 2
+
+def lap_halves(lap, halftime):
+    """Return the index ranges of the lap's trackpoints up to and from the halftime (both included)"""
+    time = lap['Lap'].time
+    return (slice(0, np.searchsorted(time, halftime, side="right")),
+            slice(np.searchsorted(time, halftime, side="left"), len(time)))
+
+# PARSE ALL LAPS' DATA AT ONCE
+def concatenate_laps(laps):
+    """Concatenate the trackpoint columns of a list of laps into one Lap record, plus the laps' offsets:
+       lap i spans offsets[i]:offsets[i+1]. An extra, last trackpoint is appended to every column
+       so that reductions can always index one past a lap's end"""
+    offsets = np.cumsum([0] + [len(lap['Lap'].time) for lap in laps]).astype(np.int64)
+    def column(name):
+        arrays = [getattr(lap['Lap'], name) for lap in laps]
+        return np.concatenate(arrays + [np.zeros(1, dtype=arrays[0].dtype if arrays else np.float64)])
+    return Lap(None, column("time"), column("bpm"), column("distance"), None, None), offsets
+
+def segment_sums(values, starts, ends):
+    """Sum values over every [start, end) segment, with a single cumulative sum"""
+    cumulative = np.concatenate([[0], np.cumsum(values, dtype=np.float64 if values.dtype.kind == "f" else np.int64)])
+    return cumulative[ends] - cumulative[starts]
+
+def segment_reduce(ufunc, values, starts, ends):
+    """Reduce values with ufunc over every non-empty [start, end) segment, in one reduceat call"""
+    if len(starts) == 0:
+        return np.zeros(0, dtype=values.dtype)
+    # Segment i is reduced at bounds[2 * i]; the odd positions only cover the gaps between segments
+    bounds = np.column_stack([starts, ends]).ravel()
+    return ufunc.reduceat(values, bounds)[::2]
+
+def segment_ranges(values, starts, ends):
+    """Return max - min of float32 values (distances) over every non-empty [start, end) segment,
+       computed in float64 from their recorded values"""
+    return (recorded_values(segment_reduce(np.maximum, values, starts, ends))
+            - recorded_values(segment_reduce(np.minimum, values, starts, ends)))
+
+def drift_columns(laps, treadmill=None):
+    """Compute the numeric columns of all laps in one vectorized pass over their concatenated trackpoints.
+       Return a dictionary of arrays, one value per lap, named as the lap rows' keys"""
+    columns, offsets = concatenate_laps(laps)
+    starts, ends = offsets[:-1], offsets[1:]
+    counts = ends - starts
+    lap_of = np.repeat(np.arange(len(laps)), counts)     # the lap of every trackpoint
+    # Half point of every lap, then the number of trackpoints up to (and strictly before) it.
+    # Lap times are sorted, so these counts are the half split's searchsorted indices
+    first_times = segment_reduce(np.minimum, columns.time, starts, ends)
+    last_times = segment_reduce(np.maximum, columns.time, starts, ends)
+    halftimes = first_times + (last_times - first_times) // 2
+    lap_time = columns.time[:-1]
+    first_half_end = starts + np.bincount(lap_of, weights=lap_time <= halftimes[lap_of], minlength=len(laps)).astype(np.int64)
+    second_half_start = starts + np.bincount(lap_of, weights=lap_time < halftimes[lap_of], minlength=len(laps)).astype(np.int64)
+
+    total_time = np.array([lap['TotalTimeSeconds'] for lap in laps], dtype=np.int64)
+    data = {}
+    data["Total distance"] = recorded_values(columns.distance[ends - 1]) - recorded_values(columns.distance[starts])
+    data["# Trackpoints"] = counts
+    data["Avg. BPM"] = segment_sums(columns.bpm, starts, ends) / counts
+    data["Halftime"] = halftimes
+    data["1st half distance"] = segment_ranges(columns.distance, starts, first_half_end)
+    data["1st half avg. BPM"] = segment_sums(columns.bpm, starts, first_half_end) / (first_half_end - starts)
+    data["2nd half distance"] = segment_ranges(columns.distance, second_half_start, ends)
+    data["2nd half avg. BPM"] = segment_sums(columns.bpm, second_half_start, ends) / (ends - second_half_start)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Laps with 0 time get inf/NaN speeds here; parse_laps reports and skips them
+        if not treadmill:
+            data["Speed (m/s)"] = data["Total distance"] / total_time
+            data["1st half speed (m/s)"] = data["1st half distance"] / (total_time / 2)
+            data["2nd half speed (m/s)"] = data["2nd half distance"] / (total_time / 2)
+        else:
+            for column in ["Speed (m/s)", "1st half speed (m/s)", "2nd half speed (m/s)"]:
+                data[column] = np.full(len(laps), min_miles2meter_sec(treadmill))
+        data["1st half speed/avg. BPM ratio"] = data["1st half speed (m/s)"] / data["1st half avg. BPM"]
+        data["2nd half speed/avg. BPM ratio"] = data["2nd half speed (m/s)"] / data["2nd half avg. BPM"]
+        # 1st/2nd half cardiac drift
+        data["1st/2nd half drift"] = (data["2nd half speed/avg. BPM ratio"] - data["1st half speed/avg. BPM ratio"]) / data["1st half speed/avg. BPM ratio"]
+        data['1st/2nd hald BPM-only drift'] = (data["2nd half avg. BPM"] - data["1st half avg. BPM"]) / data["1st half avg. BPM"]
+    return data
+
+def pace_string(speed):
+    """Format a speed in m/s as a min:mi pace string"""
+    return mil_min_val_to_mil_min_string(meter_sec_2_min_miles(speed))
+
+# The keys of the rows returned by parse_laps, in order. Laps skipped for 0 time only have the first 8
+LAP_COLUMNS = ["Filename", "Beginning time", "End time", "Duration", "Total distance", "# Trackpoints", "Total time",
+               "Avg. BPM", "Speed (m/s)", "Pace (min:mi)", "Halftime",
+               "1st half distance", "1st half speed (m/s)", "1st half pace (min:mi)", "1st half avg. BPM", "1st half speed/avg. BPM ratio",
+               "2nd half distance", "2nd half speed (m/s)", "2nd half pace (min:mi)", "2nd half avg. BPM", "2nd half speed/avg. BPM ratio",
+               "1st/2nd half drift", "1st/2nd hald BPM-only drift"]
+
+def parse_laps(laps, treadmill=None, local_time=True):
+    """ Parse each lap's basic info into a row (a dictionary) of extracted and computed data.
+        The numeric columns of all laps are computed at once by drift_columns.
+        If treadmill is a pace in decimal min/mi, use it instead of the recorded speed.
+        Rows hold no trackpoints, the laps are left to the caller.
+        Return the list of rows, with the LAP_COLUMNS keys."""
+    laps = list(laps)
+    with stage("drift") as current:
+        current.add("laps", len(laps))
+        data = drift_columns(laps, treadmill)
+    all_laps_data = [] # the list of dictionaries for the dataframe data 
+    lookups = cache_stats()
+    for i, lap in enumerate(laps):
+        lap_row = {}  # a row in the dataframe with all the data for the lap
+        # general info
+        lap_row["Filename"] = lap["Filename"]
+        with stage("local time"):
+            lap_row["Beginning time"], lap_row["End time"], lap_row["Duration"] = get_lap_times_and_duration(lap, local_time)
+
+        # All lap data
+        lap_row["Total distance"] = data["Total distance"][i]
+        lap_row["# Trackpoints"] = int(data["# Trackpoints"][i])
+        lap_row["Total time"] = lap['TotalTimeSeconds']
+        lap_row["Avg. BPM"] = data["Avg. BPM"][i]
+        if not treadmill and lap_row["Total time"] == 0:
+            print("float division by zero", file=sys.stderr)
+            print("Lap {} has 0 distance and/or 0 time. Skipping ".format(i), file=sys.stderr)
+            all_laps_data.append(lap_row)
+            continue
+        lap_row["Speed (m/s)"] = data["Speed (m/s)"][i]
+        lap_row["Pace (min:mi)"] = pace_string(lap_row["Speed (m/s)"])
+        # An aware UTC datetime: csv output keeps its +00:00 offset, as the Trackpoints times do
+        lap_row["Halftime"] = datetime64_2_datetime(epoch_ns_2_datetime64(data["Halftime"][i])).replace(tzinfo=timezone.utc)
+
+        # First and second half data
+        for half in ["1st", "2nd"]:
+            lap_row[half + " half distance"] = data[half + " half distance"][i]
+            lap_row[half + " half speed (m/s)"] = data[half + " half speed (m/s)"][i]
+            lap_row[half + " half pace (min:mi)"] = pace_string(lap_row[half + " half speed (m/s)"])
+            lap_row[half + " half avg. BPM"] = data[half + " half avg. BPM"][i]
+            lap_row[half + " half speed/avg. BPM ratio"] = data[half + " half speed/avg. BPM ratio"][i]
+
+        # 1st/2nd half cardiac drift
+        lap_row["1st/2nd half drift"] = data["1st/2nd half drift"][i]
+        lap_row['1st/2nd hald BPM-only drift'] = data['1st/2nd hald BPM-only drift'][i]
+        all_laps_data.append(lap_row)
+    # The time zone lookups of these laps, reported by --profile (and shipped back from -j workers)
+    after = cache_stats()
+    if after["hits"] + after["misses"] > lookups["hits"] + lookups["misses"]:
+        stage("local time").add("time zone hits", after["hits"] - lookups["hits"])
+        stage("local time").add("time zone misses", after["misses"] - lookups["misses"])
+    return all_laps_data
+
+def compute_aerobic_drift(files, treadmill_pace=None, local_time=True, cache=None):
+    """Compute average BPM and the 1st/2nd half cardiac drift of every lap in a collection of TCX sources.
+       treadmill_pace (decimal min/mi) replaces the recorded speed. Local times need timezonefinder,
+       UTC is used without it. Return a list of lap rows (dictionaries)"""
+    return parse_laps(parse_tcx_lap(read_tcx_files(files, cache)), treadmill_pace, local_time)
+
+
+# DRIFT CURVES
+# Columns of the long-format table returned by drift_curves, one row per lap and window
+CURVE_COLUMNS = ["lap", "Filename", "Window", "Start (s)", "End (s)", "Distance", "# Trackpoints", "Avg. BPM",
+                 "Speed (m/s)", "Speed/avg. BPM ratio", "Drift", "BPM-only drift"]
+
+def window_bounds(time, segments=None, window=None, stride=None):
+    """Return the start and end times (epoch nanoseconds) of a lap's analysis windows: either
+       segments equal parts of the lap, or windows of window seconds every stride seconds
+       (stride defaults to window). Windows that do not fit in the lap are left out"""
+    first, last = int(time[0]), int(time[-1])
+    if segments:
+        edges = first + ((last - first) * np.arange(segments + 1)) // segments
+        return edges[:-1], edges[1:]
+    window_ns = int(round(window * NANOSECONDS))
+    stride_ns = int(round((stride or window) * NANOSECONDS))
+    if window_ns <= 0 or stride_ns <= 0:
+        raise ValueError("The window and its stride must be positive")
+    starts = np.arange(first, last - window_ns + 1, stride_ns, dtype=np.int64)
+    return starts, starts + window_ns
+
+def lap_drift_curve(lap, segments=None, window=None, stride=None, treadmill=None):
+    """Compute the speed/BPM ratio of a lap over N equal segments or over sliding windows, with
+       one cumulative sum and two searchsorted calls whatever the number of windows.
+       Return a dictionary of arrays, one value per window. Drifts are relative to the first window"""
+    time = lap.time
+    starts, ends = window_bounds(time, segments, window, stride)
+    # Windows are [start, end), but the last segment includes the lap's last trackpoint
+    first_index = np.searchsorted(time, starts, side="left")
+    end_index = np.searchsorted(time, ends, side="left")
+    if segments and len(end_index):
+        end_index[-1] = len(time)
+    counts = end_index - first_index
+    seconds = (ends - starts) / NANOSECONDS
+    # Distance is interpolated at the window's bounds, so that windows share no gap nor overlap
+    elapsed = (time - time[0]) / NANOSECONDS
+    lap_distance = recorded_values(lap.distance)
+    start_distance = np.interp((starts - time[0]) / NANOSECONDS, elapsed, lap_distance)
+    end_distance = np.interp((ends - time[0]) / NANOSECONDS, elapsed, lap_distance)
+    curve = {}
+    curve["Window"] = np.arange(len(starts))
+    curve["Start (s)"] = (starts - time[0]) / NANOSECONDS
+    curve["End (s)"] = (ends - time[0]) / NANOSECONDS
+    curve["Distance"] = end_distance - start_distance
+    curve["# Trackpoints"] = counts
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Empty and zero-length windows get NaN values
+        curve["Avg. BPM"] = segment_sums(lap.bpm, first_index, end_index) / counts
+        if treadmill:
+            curve["Speed (m/s)"] = np.full(len(starts), min_miles2meter_sec(treadmill))
+        else:
+            curve["Speed (m/s)"] = curve["Distance"] / seconds
+        curve["Speed/avg. BPM ratio"] = curve["Speed (m/s)"] / curve["Avg. BPM"]
+        ratio, bpm = curve["Speed/avg. BPM ratio"], curve["Avg. BPM"]
+        curve["Drift"] = (ratio - ratio[:1]) / ratio[:1]
+        curve["BPM-only drift"] = (bpm - bpm[:1]) / bpm[:1]
+    return curve
+
+def drift_curves(laps, segments=None, window=None, stride=None, treadmill=None):
+    """Compute the drift curves of a list of laps, as prepared by parse_tcx_lap, by N equal segments
+       or by sliding windows of window seconds every stride seconds.
+       Return a long-format table: a dictionary of CURVE_COLUMNS arrays, one row per lap and window,
+       where lap is the lap's position in laps, as in the rows returned by parse_laps"""
+    if not segments and not window:
+        raise ValueError("Either a number of segments or a window length is needed")
+    if segments is not None and segments < 1:
+        raise ValueError("The number of segments must be at least 1")
+    curves = []
+    with stage("curves") as current:
+        for i, lap in enumerate(laps):
+            curve = lap_drift_curve(lap['Lap'], segments, window, stride, treadmill)
+            curve["lap"] = np.full(len(curve["Window"]), i)
+            curve["Filename"] = np.full(len(curve["Window"]), lap["Filename"], dtype=object)
+            curves.append(curve)
+            current.add("windows", len(curve["Window"]))
+    return dict((name, np.concatenate([curve[name] for curve in curves]) if curves else np.zeros(0))
+                for name in CURVE_COLUMNS)
+
+def compute_drift_curves(files, segments=None, window=None, stride=None, treadmill_pace=None, cache=None):
+    """Compute the drift curves of every lap in a collection of TCX sources, by N equal segments
+       or by sliding windows of window seconds every stride seconds. Return a drift_curves table"""
+    return drift_curves(parse_tcx_lap(read_tcx_files(files, cache)), segments, window, stride, treadmill_pace)
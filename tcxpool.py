@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# tcxpool.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# tcxpool.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tcxpool.py. If not, see http://www.gnu.org/licenses/.
+
+"""Run a per-file function over a list of TCX files, optionally in a pool of processes.
+
+Results come back in input-file order, and whatever a worker prints on stderr
+(the scripts' "Skipping" messages) is replayed in that same order, as are the
+workers' --profile statistics."""
+
+from __future__ import print_function
+import sys, os
+from io import StringIO
+from contextlib import redirect_stderr
+import tcxprofile
+
+
+def jobs_number(value):
+    """Validate the -j/--jobs argument: a positive number of processes, 0 meaning one per CPU"""
+    jobs = int(value)
+    if jobs < 0:
+        raise ValueError("The number of jobs cannot be negative")
+    return jobs or os.cpu_count() or 1
+
+def _capture_stderr(worker, filename, profile=False):
+    """Call worker on filename in a pool process. Return its result, everything it printed on stderr
+       and, if profile, the statistics of the stages it ran"""
+    tcxprofile.enable(profile)
+    tcxprofile.take()    # forget the statistics a forked process inherits from its parent
+    with StringIO() as messages, redirect_stderr(messages):
+        result = worker(filename)
+        return result, messages.getvalue(), tcxprofile.take() if profile else None
+
+def map_files(worker, filenames, jobs=1):
+    """Apply worker (a picklable function of one filename) to every file, using up to jobs processes.
+       Yield the results in the order of filenames."""
+    if jobs <= 1 or len(filenames) <= 1:
+        for filename in filenames:
+            yield worker(filename)
+        return
+    # Only parallel runs pay for importing the executor and multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    # Hand out files in small batches: enough to keep all processes busy, few enough to limit overhead
+    chunksize = max(1, len(filenames) // (jobs * 4))
+    profile = [tcxprofile.is_enabled()] * len(filenames)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for result, messages, stats in pool.map(_capture_stderr, [worker] * len(filenames), filenames, profile, chunksize=chunksize):
+            sys.stderr.write(messages)
+            if stats:
+                tcxprofile.merge(stats)
+            yield result
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# tcxprofile.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# tcxprofile.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tcxprofile.py. If not, see http://www.gnu.org/licenses/.
+
+"""Opt-in instrumentation of the pipeline stages of tcxzones and tcxaet.
+
+Code wraps a stage in "with stage(name) as current:" and may count the items it handles
+with current.add("laps", n). Every stage records its wall time, number of calls, item counts
+and its peak allocations: the most memory, traced by tracemalloc, it allocated on top of what
+it was handed (libxml2's own allocations are not traced). Until enable() is called, stage returns
+a shared do-nothing object, so instrumented code pays for one function call and no clock."""
+
+from __future__ import print_function
+import sys, json, time, tracemalloc
+from collections import OrderedDict
+
+MB = 1024. * 1024.
+
+_enabled = False
+_started_tracing = False
+_stats = OrderedDict()
+# The running stages, innermost last
+_running = []
+
+
+class _Stage(object):
+    """A running, recorded stage"""
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if _running:
+            # The enclosing stage's peak so far, before this stage resets it
+            _running[-1].peak = max(_running[-1].peak, peak)
+        self.held = self.peak = current
+        tracemalloc.reset_peak()
+        _running.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        _running.remove(self)
+        if _running:
+            _running[-1].peak = max(_running[-1].peak, peak)
+        stats = _stage_stats(self.name)
+        stats["seconds"] += elapsed
+        stats["calls"] += 1
+        stats["peak_alloc_mb"] = max(stats["peak_alloc_mb"], (peak - self.held) / MB)
+        return False
+
+    def add(self, item, n=1):
+        """Count n more items (files, laps, trackpoints...) handled by this stage"""
+        items = _stage_stats(self.name)["items"]
+        items[item] = items.get(item, 0) + int(n)
+
+class _NullStage(object):
+    """What stage returns while profiling is off: does nothing, as cheaply as possible"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, item, n=1):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+
+def _stage_stats(name):
+    """Return the statistics of a stage, creating them on first use"""
+    if name not in _stats:
+        _stats[name] = {"seconds": 0., "calls": 0, "items": {}, "peak_alloc_mb": 0.}
+    return _stats[name]
+
+def enable(enabled=True):
+    """Turn profiling on (or off) in this process, with the allocation tracing it needs"""
+    global _enabled, _started_tracing
+    _enabled = enabled
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracing = True
+    elif not enabled and _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+
+def is_enabled():
+    """Return True if stages are being recorded"""
+    return _enabled
+
+def stage(name):
+    """Return a context manager timing the named stage, a do-nothing one if profiling is off"""
+    return _Stage(name) if _enabled else _NULL_STAGE
+
+def take():
+    """Return the statistics recorded so far and start afresh (used to ship a pool worker's statistics)"""
+    global _stats
+    stats, _stats = _stats, OrderedDict()
+    return stats
+
+def merge(stats):
+    """Add statistics recorded in another process to this process' ones"""
+    for name, other in stats.items():
+        mine = _stage_stats(name)
+        mine["seconds"] += other["seconds"]
+        mine["calls"] += other["calls"]
+        mine["peak_alloc_mb"] = max(mine["peak_alloc_mb"], other["peak_alloc_mb"])
+        for item, n in other["items"].items():
+            mine["items"][item] = mine["items"].get(item, 0) + n
+
+def report(file=sys.stderr, wall_time=None):
+    """Print a table of the recorded stages on file"""
+    print("{0:<12} {1:>10} {2:>8} {3:>15}  {4}".format("stage", "time (s)", "calls", "peak alloc (MB)", "items"), file=file)
+    for name, stats in _stats.items():
+        items = ", ".join("{0} {1}".format(n, item) for item, n in stats["items"].items())
+        print("{0:<12} {1:>10.3f} {2:>8d} {3:>15.1f}  {4}".format(name, stats["seconds"], stats["calls"], stats["peak_alloc_mb"], items), file=file)
+    if wall_time is not None:
+        print("{0:<12} {1:>10.3f}".format("total", wall_time), file=file)
+
+def write_json(filename, wall_time=None):
+    """Write the recorded stages to filename as JSON"""
+    with open(filename, "w") as json_file:
+        json.dump({"wall_time": wall_time, "stages": _stats}, json_file, indent=1)
+
+
+# COMMAND LINE
+def add_profile_arguments(group):
+    """Add the profiling options to an argparse argument group"""
+    group.add_argument("--profile", action="store_true", default=False, help="Print the time, calls, items and peak allocations of every processing stage on stderr (tracing allocations slows the run)")
+    group.add_argument("--profile-json", default=None, help="Write the --profile statistics as JSON to PROFILE_JSON")
+    group.add_argument("--cprofile", default=None, help="Dump cProfile statistics of the main process to CPROFILE (readable with pstats)")
+
+class ProfileSession(object):
+    """The profiling selected on the command line, started and finished around a whole run"""
+    def __init__(self, args):
+        self.table = args.profile
+        self.stages = args.profile or bool(args.profile_json)
+        self.json = args.profile_json
+        self.cprofile = args.cprofile
+        self.profiler = None
+
+    def __enter__(self):
+        enable(self.stages)
+        self.start = time.perf_counter()
+        if self.cprofile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.cprofile)
+        wall_time = time.perf_counter() - self.start
+        if self.table:
+            report(sys.stderr, wall_time)
+        if self.json:
+            write_json(self.json, wall_time)
+        return False
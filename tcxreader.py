@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# tcxreader.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# tcxreader.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tcxreader.py. If not, see http://www.gnu.org/licenses/.
+
+"""Streaming reader for Garmin's TCX files, shared by tcxzones.py and tcxaet.py.
+
+The reader walks the file with lxml's iterparse and clears every element as
+soon as it has been consumed, so memory use does not grow with file size."""
+
+import warnings
+from collections import namedtuple
+import numpy as np
+
+# CONSTANTS
+# Defining a dictionary of Garmin's TCX format namespaces
+# All non-default namespaces defined in Garmin's TCX files as of Jan 2020, for future reference
+#NSMAP = {"ns5" : "http://www.garmin.com/xmlschemas/ActivityGoals/v1",
+         #"ns3" : "http://www.garmin.com/xmlschemas/ActivityExtension/v2",
+         #"ns2" : "http://www.garmin.com/xmlschemas/UserProfile/v2",
+         #"tcd" : "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2",
+         #"xsi" : "http://www.w3.org/2001/XMLSchema-instance",
+         #"ns4" : "http://www.garmin.com/xmlschemas/ProfileExtension/v1"}
+
+# Garmin's TCX format default namespace
+NSMAP = {"tcd" : "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"}
+TCD = "{" + NSMAP["tcd"] + "}"
+
+# Fully qualified tags used while streaming
+ACTIVITY      = TCD + "Activity"
+LAP           = TCD + "Lap"
+TRACKPOINT    = TCD + "Trackpoint"
+ID            = TCD + "Id"
+TIME          = TCD + "Time"
+TOTAL_TIME    = TCD + "TotalTimeSeconds"
+DISTANCE      = TCD + "DistanceMeters"
+HEART_RATE    = TCD + "HeartRateBpm"
+VALUE         = TCD + "Value"
+POSITION      = TCD + "Position"
+LATITUDE      = TCD + "LatitudeDegrees"
+LONGITUDE     = TCD + "LongitudeDegrees"
+
+# Records produced by the reader
+# time is the raw TCX (UTC) time string, every other missing value is None
+Trackpoint = namedtuple("Trackpoint", ["time", "bpm", "distance", "lat", "lon"])
+LapSummary = namedtuple("LapSummary", ["activity_id", "sport", "start_time", "total_time_seconds",
+                                       "distance_meters", "trackpoints"])
+ActivitySummary = namedtuple("ActivitySummary", ["activity_id", "sport", "total_time_seconds",
+                                                 "total_distance_meters", "laps", "trackpoints"])
+# A lap's Trackpoints as contiguous typed arrays: UTC epoch nanoseconds (int64), BPM (uint8, or uint16
+# if needed), distance in meters (float32), latitude and longitude (float64, NaN when missing)
+Lap = namedtuple("Lap", ["summary", "time", "bpm", "distance", "lat", "lon"])
+# All the Trackpoints of a file as the same arrays, with missing values kept (NaT time, 0 BPM, NaN
+# distance), plus the file's lap and activity summaries. Lap i spans lap_offsets[i]:lap_offsets[i+1]
+FileColumns = namedtuple("FileColumns", ["laps", "activities", "lap_offsets", "time", "bpm", "distance", "lat", "lon"])
+NAT = np.iinfo(np.int64).min    # numpy's NaT as epoch nanoseconds
+
+
+def _float_or_none(text):
+    """Convert an element's text to float, None if the element was missing"""
+    return None if text is None else float(text)
+
+def _release(elem):
+    """Clear an element and drop its already processed siblings to free memory"""
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+def _parse_trackpoint(elem):
+    """Build a Trackpoint record from a Trackpoint element, walking its children only once"""
+    time = bpm = distance = lat = lon = None
+    for child in elem:
+        tag = child.tag
+        if tag == TIME:
+            time = child.text
+        elif tag == HEART_RATE:
+            bpm = int(child.findtext(VALUE))
+        elif tag == DISTANCE:
+            distance = float(child.text)
+        elif tag == POSITION:
+            for coord in child:
+                if coord.tag == LATITUDE:
+                    lat = float(coord.text)
+                elif coord.tag == LONGITUDE:
+                    lon = float(coord.text)
+    return Trackpoint(time, bpm, distance, lat, lon)
+
+def _parse_times(times):
+    """Convert a sequence of TCX time strings into an int64 array of UTC epoch nanoseconds"""
+    if len(times) == 0:
+        return np.empty(0, dtype=np.int64)
+    with warnings.catch_warnings():
+        # Garmin's times are always UTC and only need the trailing Z dropped. Explicit UTC offsets
+        # are applied correctly by numpy, which just warns that it will not keep them
+        warnings.simplefilter("ignore", UserWarning)
+        return np.char.rstrip(np.array(times), "Z").astype("datetime64[ns]").view(np.int64)
+
+
+def iter_tcx(source):
+    """Stream a TCX file (a filename or a binary file object) in document order.
+       Yield (event, record) tuples where event is one of "trackpoint", "lap" or "activity"
+       and record the corresponding Trackpoint, LapSummary or ActivitySummary.
+       Lap and activity summaries come after all the trackpoints they contain."""
+    # Imported on first parse: runs served from the cache never load lxml
+    import lxml.etree as ET
+    activity_id = sport = None
+    lap_trackpoints = activity_trackpoints = activity_laps = 0
+    activity_time = activity_distance = 0.
+    for _, elem in ET.iterparse(source, events=("end",), tag=(TRACKPOINT, LAP, ACTIVITY)):
+        if elem.tag == TRACKPOINT:
+            lap_trackpoints += 1
+            yield "trackpoint", _parse_trackpoint(elem)
+        elif elem.tag == LAP:
+            if activity_id is None:
+                # The activity's Id precedes its laps and is gone once the first lap is released
+                activity = elem.getparent()
+                activity_id = activity.findtext(ID)
+                sport = activity.get("Sport")
+            lap = LapSummary(activity_id, sport, elem.get("StartTime"),
+                             _float_or_none(elem.findtext(TOTAL_TIME)),
+                             _float_or_none(elem.findtext(DISTANCE)),
+                             lap_trackpoints)
+            activity_laps += 1
+            activity_trackpoints += lap_trackpoints
+            activity_time += lap.total_time_seconds or 0.
+            activity_distance += lap.distance_meters or 0.
+            lap_trackpoints = 0
+            yield "lap", lap
+        else:
+            if activity_id is None:
+                activity_id = elem.findtext(ID)
+                sport = elem.get("Sport")
+            yield "activity", ActivitySummary(activity_id, sport, activity_time, activity_distance,
+                                              activity_laps, activity_trackpoints)
+            activity_id = sport = None
+            activity_trackpoints = activity_laps = 0
+            activity_time = activity_distance = 0.
+        _release(elem)
+
+def iter_trackpoints(source):
+    """Stream all the Trackpoints in a TCX file as Trackpoint records"""
+    for event, record in iter_tcx(source):
+        if event == "trackpoint":
+            yield record
+
+def iter_laps(source):
+    """Stream all the laps in a TCX file.
+       Yield (LapSummary, list of Trackpoint records) tuples, holding only one lap in memory at a time"""
+    trackpoints = []
+    for event, record in iter_tcx(source):
+        if event == "trackpoint":
+            trackpoints.append(record)
+        elif event == "lap":
+            yield record, trackpoints
+            trackpoints = []
+
+def iter_activities(source):
+    """Stream the ActivitySummary of every activity in a TCX file"""
+    for event, record in iter_tcx(source):
+        if event == "activity":
+            yield record
+
+def _raw_columns(trackpoints):
+    """Convert Trackpoint records into (time, bpm, distance, lat, lon) arrays, one vectorized conversion per column.
+       Missing values become NaT for time, 0 for BPM and NaN for distance and coordinates."""
+    time, bpm, distance, lat, lon = zip(*trackpoints) if trackpoints else ((), (), (), (), ())
+    bpm = np.array([b or 0 for b in bpm], dtype=np.uint16)
+    if len(bpm) == 0 or bpm.max() <= np.iinfo(np.uint8).max:
+        bpm = bpm.astype(np.uint8)
+    return (_parse_times([t or "NaT" for t in time]), bpm,
+            np.array(distance, dtype=np.float32),   # None becomes NaN
+            np.array(lat, dtype=np.float64),
+            np.array(lon, dtype=np.float64))
+
+def recorded_values(values):
+    """Return float32 values (distances) as the float64 values of their shortest decimal form, the one
+       written in the TCX file: 295.9 rather than 295.8999938964844, so float32 storage adds no noise to results"""
+    return np.asarray(values, dtype=np.float32).astype(str).astype(np.float64)
+
+def _usable_lap(summary, time, bpm, distance, lat, lon):
+    """Build a Lap from raw columns, dropping the trackpoints missing time, heart rate or distance
+       so that all columns stay aligned"""
+    usable = (time != NAT) & (bpm > 0) & ~np.isnan(distance)
+    if usable.all():
+        return Lap(summary, time, bpm, distance, lat, lon)
+    return Lap(summary, time[usable], bpm[usable], distance[usable], lat[usable], lon[usable])
+
+def lap_columns(summary, trackpoints):
+    """Convert a lap's Trackpoint records into a Lap of typed arrays, one vectorized conversion per column.
+       Trackpoints missing time, heart rate or distance are dropped, so that all columns stay aligned."""
+    return _usable_lap(summary, *_raw_columns(trackpoints))
+
+def iter_lap_columns(source):
+    """Stream all the laps in a TCX file as Lap records of typed arrays"""
+    for summary, trackpoints in iter_laps(source):
+        yield lap_columns(summary, trackpoints)
+
+def read_columns(source):
+    """Read a whole TCX file into a FileColumns record, converting one lap at a time
+       so that only the compact arrays, not the Trackpoint records, grow with file size"""
+    return columns_from_events(iter_tcx(source))
+
+def columns_from_events(events):
+    """Build a FileColumns record from the (event, record) pairs of iter_tcx"""
+    laps, activities, chunks = [], [], []
+    trackpoints = []
+    for event, record in events:
+        if event == "trackpoint":
+            trackpoints.append(record)
+        elif event == "lap":
+            laps.append(record)
+            chunks.append(_raw_columns(trackpoints))
+            trackpoints = []
+        else:
+            activities.append(record)
+    lap_offsets = np.cumsum([0] + [len(chunk[0]) for chunk in chunks]).astype(np.int64)
+    if chunks:
+        columns = [np.concatenate(column) for column in zip(*chunks)]
+    else:
+        columns = _raw_columns([])
+    return FileColumns(laps, activities, lap_offsets, *columns)
+
+def file_laps(columns):
+    """Yield the Lap records of a FileColumns record, as iter_lap_columns would from the TCX file"""
+    for i, summary in enumerate(columns.laps):
+        lap = slice(columns.lap_offsets[i], columns.lap_offsets[i + 1])
+        yield _usable_lap(summary, columns.time[lap], columns.bpm[lap], columns.distance[lap],
+                          columns.lat[lap], columns.lon[lap])
+
+def activity_offsets(columns):
+    """Return the trackpoint offsets of the activities in a FileColumns record:
+       activity i spans offsets[i]:offsets[i+1]"""
+    last_laps = np.cumsum([0] + [activity.laps for activity in columns.activities])
+    return np.asarray(columns.lap_offsets)[last_laps]
+
+def activity_start_times(columns):
+    """Return the time of the first timed trackpoint of every activity in a FileColumns record,
+       as epoch nanoseconds, NAT for activities without any"""
+    offsets = activity_offsets(columns)
+    time = np.asarray(columns.time)
+    starts = np.full(len(columns.activities), NAT, dtype=np.int64)
+    for i in range(len(starts)):
+        times = time[offsets[i]:offsets[i + 1]]
+        times = times[times != NAT]
+        if len(times):
+            starts[i] = times[0]
+    return starts
+
+def file_heart_rates(columns):
+    """Return all the heart rate values recorded in a FileColumns record"""
+    return columns.bpm[columns.bpm > 0]
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# tcxtz.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# tcxtz.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tcxtz.py. If not, see http://www.gnu.org/licenses/.
+
+"""Memoized time zone resolution for laps' coordinates.
+
+A single TimezoneFinder is created on first use and shared by all lookups. Lookups are
+cached on coordinates rounded to COORDS_DIGITS decimals (about 100 m), so the laps of an
+activity, and activities starting from the same place, resolve their time zone only once.
+For batch runs, configure(in_memory=True) loads the time zone polygons into memory:
+slower to start, much faster per lookup, and never reads the data files again."""
+
+from functools import lru_cache
+from importlib.util import find_spec
+
+# timezonefinder and pytz are only imported by the first lookup: UTC runs and laps without
+# coordinates never pay for them
+HAS_TIMEZONEFINDER = find_spec("timezonefinder") is not None and find_spec("pytz") is not None
+
+# CONSTANTS
+COORDS_DIGITS = 3
+CACHE_SIZE = 4096
+
+_finder = None
+_in_memory = False
+
+
+def configure(in_memory=False):
+    """Choose between the default, on-demand TimezoneFinder and the in-memory one for batch runs"""
+    global _finder, _in_memory
+    if in_memory != _in_memory:
+        _in_memory = in_memory
+        _finder = None
+
+def get_finder():
+    """Return the shared TimezoneFinder, creating it on first use"""
+    global _finder
+    if _finder is None:
+        from timezonefinder import TimezoneFinder
+        _finder = TimezoneFinder(in_memory=_in_memory)
+    return _finder
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _timezone_at(lng, lat):
+    """Look up the pytz time zone at rounded coordinates, None if there is none (e.g. at sea)"""
+    import pytz
+    name = get_finder().timezone_at(lng=lng, lat=lat)
+    return pytz.timezone(name) if name else None
+
+def timezone_at(coords):
+    """Return the pytz time zone at (longitude, latitude) coords, None if there is none"""
+    return _timezone_at(round(coords[0], COORDS_DIGITS), round(coords[1], COORDS_DIGITS))
+
+def cache_stats():
+    """Return the lookup counters as a dictionary: hits, misses and cached coordinates"""
+    info = _timezone_at.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+
+def clear_cache():
+    """Forget all cached lookups and reset the counters"""
+    _timezone_at.cache_clear()
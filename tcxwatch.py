@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Stefano Franchi
+#
+# tcxwatch.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# tcxwatch.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tcxwatch.py. If not, see http://www.gnu.org/licenses/.
+
+"""Watch directories for new and changed TCX files and publish up-to-date zone and drift summaries.
+
+The watcher is a long-running process: it polls the directories every INTERVAL seconds,
+adds new or changed files to a tcxindex index, and keeps running totals (a heart rate histogram
+and the laps' drift sums) that are corrected by every file it ingests, replaces or prunes,
+so that a summary costs the same whether the index holds ten activities or ten thousand.
+Files modified in the last SETTLE seconds are left for a later poll, as they may still be uploading.
+Every change publishes a JSON summary to a file (replaced atomically), to an HTTP endpoint
+(GET /, or GET /?since=VERSION to wait for the next summary) and/or to a Unix socket
+(a connection receives the current summary). Polling works on any file system; no inotify needed.
+
+Usage: tcxwatch.py --watch DIR [--watch DIR...] -z ZONES [-w] [--sport SPORT] [--publish FILE] [--http [HOST:]PORT] [--socket PATH]"""
+
+from __future__ import print_function
+import sys, os, json, math, time, signal, threading
+from datetime import datetime
+from argparse import ArgumentParser, SUPPRESS
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from tcxlib import DEFAULT_MAX_GAP, HAS_TIMEZONEFINDER, validate_zones_list, create_zones_names, zone_indices, normed_rows
+from tcxindex import connect, ingest, find_tcx_files, file_totals, lap_rows
+from tcxcache import add_cache_arguments, cache_from_args, evict
+from tcxpool import jobs_number
+
+# CONSTANTS
+LATEST_LAPS = 20
+# Longest wait of an HTTP client for the next summary, in seconds
+LONG_POLL_TIMEOUT = 30.
+
+
+class RunningTotals(object):
+    """The zone and drift totals of the indexed activities of a sport in the watched directories,
+       kept up to date file by file. The index may hold other files (e.g. a tcxindex archive): they are left out"""
+    def __init__(self, zones_edges, directories, sport=None, time_weighted=False):
+        self.zones_edges = zones_edges
+        self.directories = directories
+        self.prefixes = tuple(os.path.join(os.path.abspath(directory), "") for directory in directories)
+        self.sport = sport
+        self.time_weighted = time_weighted
+        self.samples = np.zeros(256, dtype=np.int64)
+        self.seconds = np.zeros(256, dtype=np.float64)
+        self.counts = {"activities": 0, "laps": 0, "drift_laps": 0, "drift": 0., "bpm_only_drift_laps": 0, "bpm_only_drift": 0.}
+
+    def update(self, connection, path=None, sign=1):
+        """Add (sign 1) or subtract (sign -1) the indexed totals of the file path, of all watched files if None"""
+        if path is not None and not path.startswith(self.prefixes):
+            return
+        totals = file_totals(connection, path, self.sport, self.directories)
+        if len(totals["bpm"]) and totals["bpm"].max() >= len(self.samples):
+            size = int(totals["bpm"].max()) + 1
+            self.samples = np.concatenate([self.samples, np.zeros(size - len(self.samples), dtype=np.int64)])
+            self.seconds = np.concatenate([self.seconds, np.zeros(size - len(self.seconds))])
+        self.samples[totals["bpm"]] += sign * totals["samples"]
+        self.seconds[totals["bpm"]] += sign * totals["seconds"]
+        for key in self.counts:
+            self.counts[key] += sign * totals[key]
+
+    def zone_counts(self):
+        """Return the zone counts (samples, or seconds if time_weighted) of the totals"""
+        weights = self.seconds if self.time_weighted else self.samples
+        indices = zone_indices(np.arange(len(weights)), self.zones_edges)
+        counts = np.bincount(indices[indices >= 0], weights=weights[indices >= 0], minlength=len(self.zones_edges) - 1)
+        return counts if self.time_weighted else counts.astype(np.int64)
+
+    def summary(self, connection, latest=LATEST_LAPS):
+        """Return the totals as a JSON-ready dictionary, with the latest laps in the index"""
+        counts = self.zone_counts()
+        frequencies = normed_rows(counts[np.newaxis].astype(np.float64))[0]
+        drift_laps, bpm_only_drift_laps = self.counts["drift_laps"], self.counts["bpm_only_drift_laps"]
+        return {"updated": datetime.now().isoformat(),
+                "sport": self.sport,
+                "time_weighted": self.time_weighted,
+                "activities": self.counts["activities"],
+                "laps": self.counts["laps"],
+                "zones": [{"zone": name, "low": low, "high": high, "count": count.item(), "frequency": float(frequency)}
+                          for name, low, high, count, frequency in zip(create_zones_names(self.zones_edges), self.zones_edges[:-1],
+                                                                        self.zones_edges[1:], counts, frequencies)],
+                "mean drift": self.counts["drift"] / drift_laps if drift_laps else None,
+                "mean BPM-only drift": self.counts["bpm_only_drift"] / bpm_only_drift_laps if bpm_only_drift_laps else None,
+                "latest laps": lap_rows(connection, self.sport, latest=latest, directories=self.directories)}
+
+
+def _finite(value):
+    """Replace the infinite and NaN floats in a JSON-ready structure by None, which strict JSON allows"""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return dict((key, _finite(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_finite(item) for item in value]
+    return value
+
+class Publisher(object):
+    """The latest summary, numbered, written to a file if given and handed to the HTTP and socket clients"""
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.condition = threading.Condition()
+        self.version = 0
+        self.text = "{}"
+
+    def publish(self, summary):
+        """Make summary the current one, and wake up the clients waiting for it"""
+        with self.condition:
+            self.version += 1
+            summary["version"] = self.version
+            self.text = json.dumps(_finite(summary), indent=1, allow_nan=False)
+            self.condition.notify_all()
+        if self.filename:
+            # Readers never see a half-written file
+            temporary = "{0}.{1}.tmp".format(self.filename, os.getpid())
+            with open(temporary, "w") as summary_file:
+                summary_file.write(self.text)
+            os.replace(temporary, self.filename)
+
+    def current(self, since=None, timeout=LONG_POLL_TIMEOUT):
+        """Return the current summary as JSON text; if since is a version, wait (up to timeout) for a newer one"""
+        with self.condition:
+            if since is not None:
+                self.condition.wait_for(lambda: self.version > since, timeout)
+            return self.text
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    """Answer GET / and GET /?since=VERSION with the current summary"""
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path not in ("/", "/summary.json"):
+            self.send_error(404)
+            return
+        try:
+            since = int(parse_qs(url.query)["since"][0]) if "since" in parse_qs(url.query) else None
+        except ValueError:
+            self.send_error(400, "since must be a summary version number")
+            return
+        body = self.server.publisher.current(since).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class _SocketHandler(StreamRequestHandler):
+    """Send the current summary to a Unix socket client"""
+    def handle(self):
+        self.wfile.write(self.server.publisher.current().encode("utf-8") + b"\n")
+
+def start_servers(publisher, http_address=None, socket_path=None):
+    """Serve the publisher's summaries over HTTP on http_address (host, port) and/or on the Unix socket socket_path,
+       each from its own thread. Return the started servers"""
+    servers = []
+    if http_address:
+        servers.append(ThreadingHTTPServer(http_address, _HTTPHandler))
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        servers.append(ThreadingUnixStreamServer(socket_path, _SocketHandler))
+    for server in servers:
+        server.publisher = publisher
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return servers
+
+def stop_servers(servers):
+    """Stop the servers returned by start_servers, removing their Unix sockets"""
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+        if isinstance(server, ThreadingUnixStreamServer) and os.path.exists(server.server_address):
+            os.remove(server.server_address)
+
+def settled_files(directories, settle):
+    """Return the TCX files in directories not modified in the last settle seconds"""
+    now = time.time()
+    filenames = []
+    for filename in find_tcx_files(directories):
+        try:
+            if now - os.stat(filename).st_mtime >= settle:
+                filenames.append(filename)
+        except OSError:
+            continue
+    return filenames
+
+def poll(connection, directories, totals, publisher, settle=2., jobs=1, cache=None, max_gap=DEFAULT_MAX_GAP,
+         local_time=True, prune=False):
+    """Ingest the new and changed TCX files in directories, updating totals, and publish the totals if anything changed.
+       With prune, forget the indexed files of directories that no longer exist; other indexed files are left alone.
+       Return the counts returned by tcxindex.ingest"""
+    counts = ingest(connection, settled_files(directories, settle), jobs, cache, max_gap, local_time, prune, totals, directories)
+    if counts["ingested"] or counts["skipped"] or counts["pruned"]:
+        publisher.publish(totals.summary(connection))
+        if cache:
+            evict(cache.directory, cache.max_bytes)
+    return counts
+
+def watch(connection, directories, totals, publisher, interval=1., settle=2., jobs=1, cache=None,
+          max_gap=DEFAULT_MAX_GAP, local_time=True, prune=False, polls=None, verbose=0):
+    """Bring the index up to date with directories and load totals from it, publish them, then poll
+       the directories every interval seconds. Stop after polls polls if given, never otherwise"""
+    ingest(connection, settled_files(directories, settle), jobs, cache, max_gap, local_time, prune, directories=directories)
+    totals.update(connection)
+    publisher.publish(totals.summary(connection))
+    done = 0
+    while polls is None or done < polls:
+        started = time.time()
+        counts = poll(connection, directories, totals, publisher, settle, jobs, cache, max_gap, local_time, prune)
+        if verbose > 0 and (counts["ingested"] or counts["skipped"] or counts["pruned"]):
+            print("{0}: {1} ingested, {2} skipped, {3} pruned".format(datetime.now().isoformat(timespec="seconds"),
+                  counts["ingested"], counts["skipped"], counts["pruned"]), file=sys.stderr)
+        done += 1
+        if polls is None or done < polls:
+            time.sleep(max(0., interval - (time.time() - started)))
+
+
+# COMMAND LINE
+def http_address(value):
+    """Parse [HOST:]PORT, the host defaulting to localhost"""
+    host, _, port = value.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+parser = ArgumentParser(description="Watch directories for new TCX files and publish up-to-date zone and drift summaries", add_help=False)
+parser.add_argument('-h', '--help', action='help', default=SUPPRESS, help='show this help message and exit')
+parser.add_argument("--watch", action="append", required=True, metavar="DIR", help="A directory to watch for TCX files, searched recursively (can be repeated)")
+parser.add_argument("-z", "--zones", required=True, help="A list of 2 or more numbers delimiting heart rate activity zones in the form 0, n, m, k")
+parser.add_argument("-w", "--time-weighted", action="store_true", default=False, help="Count the seconds spent in every zone instead of samples")
+parser.add_argument("--sport", default=None, help="Only activities of SPORT (e.g. Running, Biking)")
+parser.add_argument("-i", "--index", default=os.environ.get("TCX_INDEX", "tcxindex.db"), help="The index file (default: $TCX_INDEX, or tcxindex.db)")
+parser.add_argument("--interval", type=float, default=1., help="Seconds between polls of the directories (default: 1)")
+parser.add_argument("--settle", type=float, default=2., help="Leave files modified in the last SETTLE seconds for a later poll (default: 2)")
+parser.add_argument("--publish", default=None, help="Write every summary as JSON to PUBLISH")
+parser.add_argument("--http", type=http_address, default=None, metavar="[HOST:]PORT", help="Serve the summary over HTTP (host default: 127.0.0.1)")
+parser.add_argument("--socket", default=None, help="Serve the summary on the Unix socket SOCKET")
+parser.add_argument("-j", "--jobs", type=jobs_number, default=1, help="Read files in parallel with JOBS processes (0 for one per CPU)")
+parser.add_argument("--max-gap", type=float, default=DEFAULT_MAX_GAP, help="Longest gap between Trackpoints counted in full by time-weighted distributions (default: {0})".format(DEFAULT_MAX_GAP))
+parser.add_argument("--utc", action="store_true", default=False, help="Store the laps' beginning and end times in UTC instead of local time")
+parser.add_argument("--prune", action="store_true", default=False, help="Forget indexed files of the watched directories that no longer exist")
+parser.add_argument("-v", "--verbose", action="count", default=0, help="Print the numbers of ingested, skipped and pruned files after every change")
+add_cache_arguments(parser)
+
+
+# main loop
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if not (args.publish or args.http or args.socket):
+        parser.error("nowhere to publish: give --publish, --http or --socket")
+    zones_edges = validate_zones_list(args.zones)
+    publisher = Publisher(args.publish)
+    servers = start_servers(publisher, args.http, args.socket)
+    # Leave through the finally clause on kill as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    connection = connect(args.index)
+    try:
+        watch(connection, args.watch, RunningTotals(zones_edges, args.watch, args.sport, args.time_weighted), publisher,
+              args.interval, args.settle, args.jobs, cache_from_args(args), args.max_gap,
+              HAS_TIMEZONEFINDER and not args.utc, args.prune, verbose=args.verbose)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_servers(servers)
+        connection.close()
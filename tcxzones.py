@@ -16,47 +16,42 @@
 # along with tcxzones.py. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import print_function        
-import sys, re
+import sys, csv
 from datetime import timedelta
 from argparse import ArgumentParser, SUPPRESS, REMAINDER
-import lxml.etree as ET
+from functools import partial
 import numpy as np
-import pandas as pd
-
-# Constants    
-# Defining a dictionary of Garmin's TCX format namespaces
-# All non-default namespaces defined in Garmin's TCX files as of Jan 2020, for future reference 
-#NSMAP = {"ns5" : "http://www.garmin.com/xmlschemas/ActivityGoals/v1",
-         #"ns3" : "http://www.garmin.com/xmlschemas/ActivityExtension/v2",
-         #"ns2" : "http://www.garmin.com/xmlschemas/UserProfile/v2",
-         #"tcd" : "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2",
-         #"xsi" : "http://www.w3.org/2001/XMLSchema-instance", 
-         #"ns4" : "http://www.garmin.com/xmlschemas/ProfileExtension/v1"}
-
-# Garmin's TCX format default namespace
-NSMAP = {"tcd" : "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"}
-METERS2MILES = 1609.34
+from tcxlib import (METERS2MILES, DEFAULT_MAX_GAP, report_skipped, validate_zones_list, create_zones_names,
+                    file_zone_counts, normed_rows, load_source)
+from tcxreader import file_laps
+from tcxcache import add_cache_arguments, cache_from_args, evict
+from tcxpool import map_files, jobs_number
+from tcxprofile import add_profile_arguments, ProfileSession, stage
+from tcxexport import add_export_arguments, export_from_args, export_zones, export_trackpoints
 
 # Auxiliary functions
-def validate_zones_list(a_list):
-    """Validate the zones list as a legal list of bin edges"""
-    try: 
-        zones_edges = [int(s) for s in re.findall(r'\b\d+\b', a_list)]
+def process_file(filename, zones_edges, cache=None, time_weighted=False, max_gap=DEFAULT_MAX_GAP, export=None):
+    """Read a TCX file, or its cached trackpoints, and bin its heart rate data into zones.
+       With export settings, also write the per-activity zones, and optionally the trackpoints, as columnar files.
+       Return a tuple (file details, per-activity zone counts), or (None, None) if the file was skipped"""
+    try:
+        if not export:
+            return file_zone_counts(filename, zones_edges, cache, time_weighted, max_gap)
+        columns = load_source(filename, cache)
+        details, activities_counts = file_zone_counts(columns, zones_edges, cache, time_weighted, max_gap)
+        with stage("export"):
+            export_zones(export, filename, details, activities_counts, create_zones_names(zones_edges))
+            if export.trackpoints:
+                export_trackpoints(export, filename, list(file_laps(columns)))
+        return details, activities_counts
     except Exception as e:
-          print(e, "All elements of zone list must be numbers")
-          sys.exit(1)
-    zones_edges=list(set(zones_edges))   # remove duplicates and turn back into list to allow sorting 
-    zones_edges.sort()
-    return zones_edges
-
-def create_zones_names(bin_edges_list):
-    """create n zone names for length of zones list - 1""" 
-    if len(bin_edges_list) < 2:
-        raise Exception("The zones list must contain at least 2 unique values")
-        sys.exit(1)
-    else:
-        return ["Z"+ str(index[0]) for index in enumerate(zones_edges) if index[0] < len(zones_edges)-1]
+        report_skipped(filename, e)
+    return None, None
     
+def csv_float(value):
+    """Format a frequency as pandas' to_csv does: the shortest repr, and nothing for NaN"""
+    return "" if value != value else repr(float(value))
+
 # Parsing command line arguments, using options for required zone arguments
 # Disable default help
 parser = ArgumentParser(description='Read heart rate data from (a list of) TCX files and output a normed distribution by athletic zones.', add_help=False)
@@ -72,75 +67,98 @@ required.add_argument("file_list", nargs=REMAINDER, help="One or more TCX or FIT
 optional.add_argument("-v", "--verbose", action="count", default=0, help = "Turn on verbose output")
 optional.add_argument("-c", "--columns", action="store_true", default=False, help="Print column headers in output")
 optional.add_argument("-d", "--details", action="store_true", default=False, help="Prepend activity's or activities' details to zone data (date, time, activity, etc.)")
-args = parser.parse_args()
+optional.add_argument("-j", "--jobs", type=jobs_number, default=1, help="Process files in parallel with JOBS processes (0 for one per CPU)")
+optional.add_argument("-w", "--time-weighted", action="store_true", default=False, help="Weight every heart rate sample by the time to the next Trackpoint, instead of counting samples")
+optional.add_argument("--max-gap", type=float, default=DEFAULT_MAX_GAP, help="With --time-weighted, count gaps between Trackpoints up to MAX_GAP seconds (default: {0})".format(DEFAULT_MAX_GAP))
+optional.add_argument("-b", "--breakdown", choices=["file", "activity"], default=None, help="Also print the distribution of every file or activity, before the aggregate one")
+add_cache_arguments(optional)
+add_export_arguments(optional)
+add_profile_arguments(optional)
 
-# Start processing
-# Validating zones list and creating zone names
-zones_edges = validate_zones_list(args.zones)
-zones_names = create_zones_names(zones_edges)
+# main loop
+if __name__ == "__main__":
+    args = parser.parse_args()
 
-# Processing all files entered on command line
+    # Start processing
+    # Validating zones list and creating zone names
+    zones_edges = validate_zones_list(args.zones)
+    zones_names = create_zones_names(zones_edges)
+    export = export_from_args(args, parser)
 
-heart_rates =[]
-files_processed ={}
-files_skipped = []
-for filename in args.file_list:
-    try:
-        with open(filename, 'r') as tcx_file:
-            try: 
-                etree = ET.parse(tcx_file)
-                # Extract heartrate data and convert to integers 
-                file_heartrate_data = etree.xpath('.//tcd:HeartRateBpm/tcd:Value/text()', namespaces=NSMAP) 
-                if len(file_heartrate_data) > 0:
-                    heart_rates.extend(file_heartrate_data)
-                    files_processed[filename]={"datetime": etree.xpath('.//tcd:Activity/tcd:Id/text()', namespaces=NSMAP)[0],
-                                               "activity_type": etree.xpath('.//tcd:Activity/@Sport', namespaces=NSMAP)[0],
-                                               "total_time_seconds": etree.xpath('.//tcd:TotalTimeSeconds/text()', namespaces=NSMAP)[0],
-                                               "total_distance_meters": etree.xpath('.//tcd:Activity/tcd:Lap/tcd:DistanceMeters/text()', namespaces=NSMAP)[0]} 
-                else:
-                    print(filename, " Does not contain usable heartrate data. Skipping", file=sys.stderr)
-                    files_skipped.append(filename)
-            except Exception as e:
-                print(filename, " is not a valid TCX file. Skipping", file=sys.stderr)
-                print(e, file=sys.stderr)
+    # --profile/--cprofile instrumentation covers the whole run
+    with ProfileSession(args):
+        # Processing all files entered on command line, possibly in parallel.
+        # Counts are accumulated as files stream past: memory grows with zones, not with samples
+        zones_counts = np.zeros(len(zones_names), dtype=np.float64 if args.time_weighted else np.int64)
+        breakdown_index = []
+        breakdown_counts = []
+        files_processed ={}
+        files_skipped = []
+        cache = cache_from_args(args)
+        worker = partial(process_file, zones_edges=zones_edges, cache=cache,
+                         time_weighted=args.time_weighted, max_gap=args.max_gap, export=export)
+        for filename, (details, activities_counts) in zip(args.file_list, map_files(worker, args.file_list, args.jobs)):
+            if details is None:
                 files_skipped.append(filename)
-    except FileNotFoundError:
-        print(filename, "does not exist in filesystem. Skipping", file=sys.stderr)
-        files_skipped.append(filename)
+            else:
+                files_processed[filename] = details
+                file_counts = activities_counts.sum(axis=0)
+                zones_counts += file_counts
+                if args.breakdown == "file":
+                    breakdown_index.append(filename)
+                    breakdown_counts.append(file_counts)
+                elif args.breakdown == "activity":
+                    breakdown_index.extend((filename, activity) for activity in details["activities"])
+                    breakdown_counts.extend(activities_counts)
+        if cache:
+            evict(cache.directory, cache.max_bytes)
 
-binned_heartrates = pd.cut((np.array(heart_rates, dtype=np.int32)), zones_edges, labels=zones_names).value_counts()                         
+        # Normalize and print everything, with the csv module: pandas takes longer to import
+        # than binning a few files takes
+        with stage("output"):
+            # Normalize binned heartrates to unit vector (NaN if there are none)
+            with np.errstate(invalid="ignore"):
+                normed_heartrates = zones_counts / zones_counts.sum()
 
-# Normalize binned heartrates to unit vector                                
-normed_heartrates = binned_heartrates.div(binned_heartrates.sum())
+            # Prepend header info if requested
+            if args.details == True:
+                for file, details in files_processed.items():
+                    print("File: ", file,
+                          " Date: ", details['datetime'],
+                          " Activity: ", details['activity_type'], 
+                          " Distance (mi): ", float(details['total_distance_meters'])/METERS2MILES,
+                          " Duration: ", str(timedelta(seconds=float(details['total_time_seconds']))))
+            # Print verbose output
+            if args.verbose > 0:
+                print("Original files:  {0:5d}".format(len(args.file_list)))
+                print("Processed files: {0:5d}".format(len(files_processed.keys())))
+                print("Skipped files:   {0:5d}".format(len(files_skipped)))
+            if args.verbose > 1:
+                print("Original file list ({0} files):".format(args.file_list))    
+                for filename in args.file_list:
+                        print(filename)
+                print("Files processed ({0} files):".format(len(files_processed.keys())))
+                for filename in files_processed:
+                    print(filename)
+                print("Files skipped, ({0} files):".format(len(files_skipped)))
+                for filename in files_skipped:
+                    print(filename)
 
-# Prepend header info if requested
-if args.details == True:
-    for file, details in files_processed.items():
-        print("File: ", file,
-              " Date: ", details['datetime'],
-              " Activity: ", details['activity_type'], 
-              " Distance (mi): ", float(details['total_distance_meters'])/METERS2MILES,
-              " Duration: ", str(timedelta(seconds=float(details['total_time_seconds']))))
-# Print verbose output
-if args.verbose > 0:
-    print("Original files:  {0:5d}".format(len(args.file_list)))
-    print("Processed files: {0:5d}".format(len(files_processed.keys())))
-    print("Skipped files:   {0:5d}".format(len(files_skipped)))
-if args.verbose > 1:
-    print("Original file list ({0} files):".format(args.file_list))    
-    for filename in args.file_list:
-            print(filename)
-    print("Files processed ({0} files):".format(len(files_processed.keys())))
-    for filename in files_processed:
-        print(filename)
-    print("Files skipped, ({0} files):".format(len(files_skipped)))
-    for filename in files_skipped:
-        print(filename)
+            writer = csv.writer(sys.stdout, lineterminator="\n")
+            # Print the per-file or per-activity distributions, one row each
+            if args.breakdown:
+                index_names = ["file"] if args.breakdown == "file" else ["file", "activity"]
+                if args.columns:
+                    writer.writerow(index_names + zones_names)
+                breakdown = normed_rows(np.array(breakdown_counts).reshape(-1, len(zones_names)))
+                for index, frequencies in zip(breakdown_index, breakdown):
+                    index = [index] if args.breakdown == "file" else list(index)
+                    writer.writerow(index + [csv_float(frequency) for frequency in frequencies])
+                print()
 
-# Return csv output with zones and frequency columns, no headers by default
-columns_names = ["frequency"]
-index_name = "zone"
-if args.columns == 0:
-    print(normed_heartrates.to_csv(header=False))
-else:
-    print(normed_heartrates.to_csv(header=columns_names, index_label=index_name))
+            # Return csv output with zones and frequency columns, no headers by default
+            if args.columns:
+                writer.writerow(["zone", "frequency"])
+            for name, frequency in zip(zones_names, normed_heartrates):
+                writer.writerow([name, csv_float(frequency)])
+            print()
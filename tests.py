@@ -16,27 +16,585 @@
 # along with TCXHeartRateZones. If not, see http://www.gnu.org/licenses/.
 
 
-import unittest
+import os, sys, json, time, shutil, subprocess, tempfile, threading, unittest
+from io import BytesIO
+from urllib.request import urlopen
+import numpy as np
+import pandas as pd
+import tcxlib
+import tcxtz
+import tcxreader
+import tcxpool
+import tcxcache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+import synthtcx
+import tcxprofile
 import tcxaet
+import tcxexport
+import tcxindex
+import tcxwatch
+import tcxbatch
+
+# A minimal TCX file: one activity, two laps, the last trackpoint has no heart rate nor position
+SAMPLE_TCX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+ <Activities>
+  <Activity Sport="Running">
+   <Id>2020-01-05T14:00:00.000Z</Id>
+   <Lap StartTime="2020-01-05T14:00:00.000Z">
+    <TotalTimeSeconds>4.0</TotalTimeSeconds>
+    <DistanceMeters>12.0</DistanceMeters>
+    <Track>
+     <Trackpoint><Time>2020-01-05T14:00:00.000Z</Time><Position><LatitudeDegrees>41.8</LatitudeDegrees><LongitudeDegrees>-87.6</LongitudeDegrees></Position><DistanceMeters>0.0</DistanceMeters><HeartRateBpm><Value>100</Value></HeartRateBpm></Trackpoint>
+     <Trackpoint><Time>2020-01-05T14:00:02.000Z</Time><Position><LatitudeDegrees>41.8</LatitudeDegrees><LongitudeDegrees>-87.6</LongitudeDegrees></Position><DistanceMeters>6.0</DistanceMeters><HeartRateBpm><Value>110</Value></HeartRateBpm></Trackpoint>
+     <Trackpoint><Time>2020-01-05T14:00:04.000Z</Time><Position><LatitudeDegrees>41.8</LatitudeDegrees><LongitudeDegrees>-87.6</LongitudeDegrees></Position><DistanceMeters>12.0</DistanceMeters><HeartRateBpm><Value>120</Value></HeartRateBpm></Trackpoint>
+    </Track>
+   </Lap>
+   <Lap StartTime="2020-01-05T14:00:05.000Z">
+    <TotalTimeSeconds>2.0</TotalTimeSeconds>
+    <DistanceMeters>8.0</DistanceMeters>
+    <Track>
+     <Trackpoint><Time>2020-01-05T14:00:05.000Z</Time><Position><LatitudeDegrees>41.8</LatitudeDegrees><LongitudeDegrees>-87.6</LongitudeDegrees></Position><DistanceMeters>16.0</DistanceMeters><HeartRateBpm><Value>130</Value></HeartRateBpm></Trackpoint>
+     <Trackpoint><Time>2020-01-05T14:00:07.000Z</Time><DistanceMeters>20.0</DistanceMeters></Trackpoint>
+    </Track>
+   </Lap>
+  </Activity>
+ </Activities>
+</TrainingCenterDatabase>
+"""
 
 class TestStringMethods(unittest.TestCase):
     
     #testing unit conversions
     def test_speed_to_pace(self):
         # Always return 0 for zero input (not 0/div exceptions) 
-        self.assertEqual(0,tcxaet.meter_sec_2_min_miles(0))
+        self.assertEqual(0,tcxlib.meter_sec_2_min_miles(0))
         # 1 m/s = 2.237 miles/hour =  26.821 mins/mile        
-        self.assertEqual(26.82, round(tcxaet.meter_sec_2_min_miles(1),2))
+        self.assertEqual(26.82, round(tcxlib.meter_sec_2_min_miles(1),2))
         # 10:00 mins/mile = 6 mi/hour = 2.682 m/s
-        self.assertEqual(10., round(tcxaet.meter_sec_2_min_miles(2.682),2))
+        self.assertEqual(10., round(tcxlib.meter_sec_2_min_miles(2.682),2))
         
     def test_pace_to_speed(self):
         self.assertEqual(0,0)
         
     def test_dec_min_mi_2_string(self):
-        self.assertEqual("10:00", tcxaet.mil_min_val_to_mil_min_string(10))
-        self.assertEqual("00:00", tcxaet.mil_min_val_to_mil_min_string(0))
-        self.assertEqual("10:15", tcxaet.mil_min_val_to_mil_min_string(10.25))
+        self.assertEqual("10:00", tcxlib.mil_min_val_to_mil_min_string(10))
+        self.assertEqual("00:00", tcxlib.mil_min_val_to_mil_min_string(0))
+        self.assertEqual("10:15", tcxlib.mil_min_val_to_mil_min_string(10.25))
         
+class TestSyntheticTCX(unittest.TestCase):
+
+    def test_deterministic_and_readable(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        paths = [os.path.join(tmpdir, name) for name in ["a.tcx", "b.tcx"]]
+        for path in paths:
+            written = synthtcx.write_synthetic_tcx(path, activities=2, laps=3, trackpoints_per_lap=50,
+                                                   gap_rate=0.2, missing_hr=0.1, missing_gps=0.5, seed=7)
+        with open(paths[0], "rb") as first, open(paths[1], "rb") as second:
+            self.assertEqual(first.read(), second.read())
+        columns = tcxlib.load_source(paths[0])
+        self.assertEqual(300, written)
+        self.assertEqual(300, len(columns.time))
+        self.assertEqual([3, 3], [activity.laps for activity in columns.activities])
+        self.assertTrue(0 < (columns.bpm == 0).sum() < 60)
+
+class TestTCXReader(unittest.TestCase):
+
+    def test_trackpoints(self):
+        trackpoints = list(tcxreader.iter_trackpoints(BytesIO(SAMPLE_TCX)))
+        self.assertEqual(5, len(trackpoints))
+        self.assertEqual(tcxreader.Trackpoint("2020-01-05T14:00:00.000Z", 100, 0., 41.8, -87.6), trackpoints[0])
+        # Missing values are None
+        self.assertEqual(tcxreader.Trackpoint("2020-01-05T14:00:07.000Z", None, 20., None, None), trackpoints[-1])
+
+    def test_laps(self):
+        laps = list(tcxreader.iter_laps(BytesIO(SAMPLE_TCX)))
+        self.assertEqual([3, 2], [len(trackpoints) for lap, trackpoints in laps])
+        lap = laps[1][0]
+        self.assertEqual(("2020-01-05T14:00:00.000Z", "Running"), (lap.activity_id, lap.sport))
+        self.assertEqual((2., 8., 2), (lap.total_time_seconds, lap.distance_meters, lap.trackpoints))
+
+    def test_activities(self):
+        activities = list(tcxreader.iter_activities(BytesIO(SAMPLE_TCX)))
+        self.assertEqual([tcxreader.ActivitySummary("2020-01-05T14:00:00.000Z", "Running", 6., 20., 2, 5)], activities)
+
+    def test_lap_columns(self):
+        laps = list(tcxreader.iter_lap_columns(BytesIO(SAMPLE_TCX)))
+        lap = laps[0]
+        self.assertEqual((np.int64, np.uint8, np.float32, np.float64),
+                         (lap.time.dtype, lap.bpm.dtype, lap.distance.dtype, lap.lat.dtype))
+        self.assertEqual(2 * 10**9, lap.time[1] - lap.time[0])
+        self.assertEqual(np.datetime64("2020-01-05T14:00:00", "ns"), lap.time[0].astype("datetime64[ns]"))
+        # The trackpoint without heart rate is dropped from the columns
+        self.assertEqual(1, len(laps[1].time))
+
+    def test_lap_halves(self):
+        lap = {'Lap': next(tcxreader.iter_lap_columns(BytesIO(SAMPLE_TCX)))}
+        halftime = tcxlib.lap_halftime_value(lap)
+        first_half, second_half = tcxlib.lap_halves(lap, halftime)
+        # The trackpoint at the halftime belongs to both halves
+        self.assertEqual([100, 110], list(lap['Lap'].bpm[first_half]))
+        self.assertEqual([110, 120], list(lap['Lap'].bpm[second_half]))
+
+class TestZones(unittest.TestCase):
+
+    def test_bin_heart_rates_matches_pandas_cut(self):
+        edges = [0, 100, 120, 130]
+        heart_rates = np.array([0, 1, 99, 100, 101, 120, 121, 130, 131, 200])
+        expected = pd.cut(heart_rates, edges).value_counts().values
+        np.testing.assert_array_equal(expected, tcxlib.bin_heart_rates(heart_rates, edges))
+
+    def test_bin_activities(self):
+        columns = tcxreader.read_columns(BytesIO(SAMPLE_TCX))
+        # The trackpoint without heart rate is not counted in the first zone
+        np.testing.assert_array_equal([[1, 3]], tcxlib.bin_activities(columns, [0, 100, 200]))
+
+    def test_time_weighted(self):
+        columns = tcxreader.read_columns(BytesIO(SAMPLE_TCX))
+        # Trackpoints at 0, 2, 4, 5 and 7 seconds, the last one without heart rate
+        np.testing.assert_array_equal([[2., 5.]], tcxlib.bin_activities(columns, [0, 105, 200], time_weighted=True))
+        np.testing.assert_array_equal([[1.5, 4.]], tcxlib.bin_activities(columns, [0, 105, 200], time_weighted=True, max_gap=1.5))
+
+    def test_details_keep_first_lap_totals(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, "two.tcx")
+        synthtcx.write_synthetic_tcx(filename, activities=2, laps=2, trackpoints_per_lap=100)
+        columns = tcxreader.read_columns(filename)
+        details, _ = tcxlib.file_zone_counts(columns, [0, 200])
+        first = columns.laps[0]
+        self.assertEqual((first.activity_id, first.total_time_seconds, first.distance_meters),
+                         (details["datetime"], details["total_time_seconds"], details["total_distance_meters"]))
+        self.assertEqual(2, len(details["activities"]))
+
+class TestDriftColumns(unittest.TestCase):
+
+    def test_matches_per_lap_half_split(self):
+        laps = tcxlib.parse_tcx_lap(tcxlib.read_tcx_files([BytesIO(SAMPLE_TCX), BytesIO(SAMPLE_TCX)]))
+        data = tcxlib.drift_columns(laps)
+        for i, lap in enumerate(laps):
+            halftime = tcxlib.lap_halftime_value(lap)
+            first_half, second_half = tcxlib.lap_halves(lap, halftime)
+            self.assertEqual(halftime, data["Halftime"][i])
+            self.assertEqual(lap['Lap'].bpm[first_half].mean(), data["1st half avg. BPM"][i])
+            self.assertEqual(lap['Lap'].bpm[second_half].mean(), data["2nd half avg. BPM"][i])
+            distance = lap['Lap'].distance[second_half]
+            self.assertEqual(float(distance.max()) - float(distance.min()), data["2nd half distance"][i])
+
+    def test_treadmill_speed(self):
+        laps = tcxlib.parse_tcx_lap(tcxlib.read_tcx_files([BytesIO(SAMPLE_TCX)]))
+        data = tcxlib.drift_columns(laps, treadmill=10)
+        np.testing.assert_allclose(2.68223, data["1st half speed (m/s)"], rtol=1e-5)
+
+    def test_distances_without_float32_noise(self):
+        # float32 stores 295.9 as 295.8999938964844
+        tcx = SAMPLE_TCX.replace(b"<DistanceMeters>12.0</DistanceMeters><HeartRateBpm>", b"<DistanceMeters>295.9</DistanceMeters><HeartRateBpm>")
+        laps = tcxlib.parse_tcx_lap(tcxlib.read_tcx_files([BytesIO(tcx)]))
+        data = tcxlib.drift_columns(laps)
+        self.assertEqual("295.9", repr(float(data["Total distance"][0])))
+        self.assertEqual("289.9", repr(float(data["2nd half distance"][0])))
+
+class TestDriftCurves(unittest.TestCase):
+
+    def test_segments_match_slicing(self):
+        laps = tcxlib.parse_tcx_lap(tcxlib.read_tcx_files([BytesIO(SAMPLE_TCX)]))
+        curves = tcxlib.drift_curves(laps[:1], segments=2)
+        np.testing.assert_array_equal([0., 2.], curves["Start (s)"])
+        # [0, 2) holds the first trackpoint, the last segment [2, 4] the other two
+        np.testing.assert_array_equal([1, 2], curves["# Trackpoints"])
+        np.testing.assert_array_equal([100., 115.], curves["Avg. BPM"])
+        np.testing.assert_array_equal([3., 3.], curves["Speed (m/s)"])
+        self.assertAlmostEqual((3. / 115. - 3. / 100.) / (3. / 100.), curves["Drift"][1])
+
+    def test_sliding_windows(self):
+        laps = tcxlib.parse_tcx_lap(tcxlib.read_tcx_files([BytesIO(SAMPLE_TCX), BytesIO(SAMPLE_TCX)]))
+        curves = tcxlib.drift_curves(laps, window=2, stride=1)
+        # Only the 4 seconds long laps fit a 2 seconds window, three times each
+        np.testing.assert_array_equal([0, 0, 0, 2, 2, 2], curves["lap"])
+        np.testing.assert_array_equal([0., 1., 2., 0., 1., 2.], curves["Start (s)"])
+        np.testing.assert_array_equal([100., 110., 110.], curves["Avg. BPM"][:3])
+
+    def test_stride_needs_window(self):
+        process = subprocess.run([sys.executable, "tcxaet.py", "-S", "30", "run.tcx"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(2, process.returncode)
+        self.assertIn("--stride needs --window", process.stderr.decode())
+
+class TestLibrary(unittest.TestCase):
+
+    def test_compute_zone_distribution(self):
+        distribution = tcxlib.compute_zone_distribution([BytesIO(SAMPLE_TCX), "/nonexistent.tcx"], [0, 105, 200])
+        self.assertEqual(["Z0", "Z1"], distribution.names)
+        np.testing.assert_array_equal([1, 3], distribution.counts)
+        np.testing.assert_array_equal([.25, .75], distribution.frequencies)
+        self.assertEqual(1, len(distribution.files))
+        self.assertEqual("/nonexistent.tcx", distribution.skipped[0][0])
+
+    def test_compute_aerobic_drift(self):
+        rows = tcxlib.compute_aerobic_drift([BytesIO(SAMPLE_TCX)], local_time=False)
+        self.assertEqual(2, len(rows))
+        self.assertEqual(110., rows[0]["Avg. BPM"])
+        self.assertEqual((115. - 105.) / 105., rows[0]["1st/2nd hald BPM-only drift"])
+        # Halftime is in UTC, and its csv text keeps the offset
+        self.assertIn(",2020-01-05 14:00:02+00:00,", tcxaet.csv_output(rows[:1], details=True))
+
+    def test_rows_hold_no_trackpoints(self):
+        rows = tcxlib.compute_aerobic_drift([BytesIO(SAMPLE_TCX)], local_time=False)
+        self.assertEqual(tcxlib.LAP_COLUMNS, list(rows[0]))
+
+    def test_streamed_csv_matches_whole_table(self):
+        rows = tcxlib.compute_aerobic_drift([BytesIO(SAMPLE_TCX), BytesIO(SAMPLE_TCX)], local_time=False)
+        out = tcxaet.StringIO()
+        tcxaet.write_csv_rows(out, rows[:2], 0, columns=True)
+        tcxaet.write_csv_rows(out, rows[2:], 2, columns=True)
+        self.assertEqual(tcxaet.csv_output(rows, columns=True), out.getvalue())
+        self.assertTrue(out.getvalue().startswith("lap,Filename,"))
+        self.assertEqual(1, out.getvalue().count("lap,Filename,"))
+
+    def test_import_is_light(self):
+        # The library must not parse the command line nor import pandas
+        code = "import sys, tcxlib; sys.exit('pandas' in sys.modules)"
+        self.assertEqual(0, subprocess.call([sys.executable, "-c", code, "--not-an-option"],
+                                            cwd=os.path.dirname(os.path.abspath(__file__))))
+
+class TestStartup(unittest.TestCase):
+    HEAVY_MODULES = ["pandas", "lxml", "timezonefinder", "pytz", "pyarrow", "concurrent.futures"]
+    STARTUP_BUDGET = 1.5    # seconds
+
+    def setUp(self):
+        self.directory = os.path.dirname(os.path.abspath(__file__))
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, "small.tcx")
+        synthtcx.write_synthetic_tcx(self.filename, laps=2, trackpoints_per_lap=100)
+
+    def loaded_modules(self, code):
+        """Return the heavy modules loaded after running code in a fresh interpreter"""
+        code += "\nimport sys; sys.stderr.write(' '.join(m for m in {0!r} if m in sys.modules))".format(self.HEAVY_MODULES)
+        process = subprocess.run([sys.executable, "-c", code], cwd=self.directory, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+        return process.stderr.decode().split()
+
+    def best_time(self, command, repeats=3):
+        """Return the best wall time of repeats runs of command"""
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.check_call(command, cwd=self.directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def test_entry_points_import_lazily(self):
+        self.assertEqual([], self.loaded_modules("import tcxzones, tcxaet, tcxindex"))
+        # A small tcxzones run parses XML, and needs nothing else
+        run = "import sys, runpy; sys.argv = ['tcxzones.py', '-z', '0,120,140', {0!r}]; runpy.run_path('tcxzones.py', run_name='__main__')"
+        self.assertEqual(["lxml"], self.loaded_modules(run.format(self.filename)))
+
+    def test_zones_startup_time(self):
+        # About 0.1 s here; the bound only catches heavy imports creeping back in, even on a loaded machine
+        self.assertLess(self.best_time([sys.executable, "tcxzones.py", "-z", "0,120,140", self.filename]), self.STARTUP_BUDGET)
+
+@unittest.skipUnless(tcxtz.HAS_TIMEZONEFINDER, "timezonefinder is not installed")
+class TestTimezone(unittest.TestCase):
+
+    def test_lookups_are_memoized(self):
+        tcxtz.clear_cache()
+        chicago = tcxtz.timezone_at((-87.6, 41.8))
+        # Within rounding distance: same cache entry
+        self.assertIs(chicago, tcxtz.timezone_at((-87.60001, 41.80001)))
+        self.assertEqual("America/Chicago", chicago.zone)
+        self.assertEqual({"hits": 1, "misses": 1, "size": 1}, tcxtz.cache_stats())
+
+    def test_local_lap_times(self):
+        tcxtz.clear_cache()
+        rows = tcxlib.compute_aerobic_drift([BytesIO(SAMPLE_TCX)])
+        self.assertEqual("2020-01-05 08:00:00-06:00", str(rows[0]["Beginning time"]))
+        # Both laps start from the same place: one lookup
+        self.assertEqual(1, tcxtz.cache_stats()["misses"])
+
+    def test_lookups_in_profile(self):
+        tcxtz.clear_cache()
+        tcxprofile.enable()
+        self.addCleanup(tcxprofile.take)
+        self.addCleanup(tcxprofile.enable, False)
+        tcxlib.compute_aerobic_drift([BytesIO(SAMPLE_TCX)])
+        self.assertEqual({"time zone hits": 1, "time zone misses": 1}, tcxprofile.take()["local time"]["items"])
+
+class TestPool(unittest.TestCase):
+
+    def test_map_files_keeps_order(self):
+        filenames = ["/data/{0}.tcx".format(i) for i in range(20)]
+        expected = [os.path.basename(f) for f in filenames]
+        self.assertEqual(expected, list(tcxpool.map_files(os.path.basename, filenames)))
+        self.assertEqual(expected, list(tcxpool.map_files(os.path.basename, filenames, jobs=3)))
+
+    def test_jobs_number(self):
+        self.assertEqual(4, tcxpool.jobs_number("4"))
+        self.assertTrue(tcxpool.jobs_number("0") >= 1)
+        self.assertRaises(ValueError, tcxpool.jobs_number, "-1")
+
+class TestProfile(unittest.TestCase):
+
+    def tearDown(self):
+        tcxprofile.enable(False)
+        tcxprofile.take()
+
+    def test_disabled_records_nothing(self):
+        tcxlib.compute_aerobic_drift([BytesIO(SAMPLE_TCX)], local_time=False)
+        self.assertEqual({}, tcxprofile.take())
+
+    def test_stages_and_merge(self):
+        tcxprofile.enable()
+        tcxlib.compute_aerobic_drift([BytesIO(SAMPLE_TCX)], local_time=False)
+        stats = tcxprofile.take()
+        self.assertEqual({"files": 1, "laps": 2, "trackpoints": 4}, stats["read"]["items"])
+        self.assertEqual(2, stats["local time"]["calls"])
+        self.assertGreater(stats["read"]["peak_alloc_mb"], 0.)
+        tcxprofile.merge(stats)
+        tcxprofile.merge(stats)
+        self.assertEqual(2, tcxprofile.take()["drift"]["calls"])
+
+    def test_nested_stage_peaks(self):
+        tcxprofile.enable()
+        with tcxprofile.stage("outer"):
+            with tcxprofile.stage("inner"):
+                block = np.ones(2 * 1024 * 1024 // 8)
+            del block
+            np.ones(1024 * 1024 // 8)
+        stats = tcxprofile.take()
+        # Each stage sees its own allocations, the enclosing one those of its inner stages too
+        self.assertAlmostEqual(2., stats["inner"]["peak_alloc_mb"], places=1)
+        self.assertAlmostEqual(2., stats["outer"]["peak_alloc_mb"], places=1)
+
+@unittest.skipUnless(tcxexport.HAS_PYARROW, "pyarrow is not installed")
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def read(self, dataset):
+        import pyarrow.dataset as ds
+        return ds.dataset(os.path.join(self.tmpdir, "export", dataset), format="parquet", partitioning="hive").to_table().to_pydict()
+
+    def test_laps_and_trackpoints(self):
+        export = tcxexport.ExportSettings(os.path.join(self.tmpdir, "export"), "parquet", "date", True)
+        filename = os.path.join(self.tmpdir, "sample.tcx")
+        with open(filename, "wb") as tcx_file:
+            tcx_file.write(SAMPLE_TCX)
+        rows, _ = tcxaet.process_file(filename, local_time=False, export=export)
+        laps = self.read("laps")
+        self.assertEqual(["2020-01-05", "2020-01-05"], laps["date"])
+        self.assertEqual([3, 1], laps["# Trackpoints"])
+        self.assertEqual([r["Avg. BPM"] for r in rows], laps["Avg. BPM"])
+        trackpoints = self.read("trackpoints")
+        self.assertEqual([0, 0, 0, 1], trackpoints["Lap"])
+        self.assertEqual([100, 110, 120, 130], trackpoints["Bpm"])
+
+    def test_zones_by_activity(self):
+        export = tcxexport.ExportSettings(os.path.join(self.tmpdir, "export"), "parquet", "activity", False)
+        details, activities_counts = tcxlib.file_zone_counts(BytesIO(SAMPLE_TCX), [0, 105, 200])
+        tcxexport.export_zones(export, "sample.tcx", details, activities_counts, ["Z0", "Z1"])
+        zones = self.read("zones")
+        self.assertEqual(["2020-01-05T14-00-00.000Z"], zones["activity"])
+        self.assertEqual([1], zones["Z0"])
+        self.assertEqual([.75], zones["Z1 frequency"])
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, "sample.tcx")
+        with open(self.filename, "wb") as tcx_file:
+            tcx_file.write(SAMPLE_TCX)
+        self.connection = tcxindex.connect(os.path.join(self.tmpdir, "index.db"))
+        self.addCleanup(self.connection.close)
+
+    def test_incremental_ingest(self):
+        self.assertEqual(1, tcxindex.ingest(self.connection, [self.tmpdir], local_time=False)["ingested"])
+        self.assertEqual(1, tcxindex.ingest(self.connection, [self.tmpdir], local_time=False)["unchanged"])
+        os.utime(self.filename, ns=(0, 10**9))
+        self.assertEqual(1, tcxindex.ingest(self.connection, [self.tmpdir], local_time=False)["ingested"])
+        self.assertEqual(1, self.connection.execute("SELECT COUNT(*) FROM activities").fetchone()[0])
+
+    def test_queries_match_files(self):
+        tcxindex.ingest(self.connection, [self.filename], local_time=False)
+        expected = tcxlib.compute_zone_distribution([self.filename], [0, 105, 200], time_weighted=True)
+        np.testing.assert_array_equal(expected.counts, tcxindex.zone_counts(self.connection, [0, 105, 200], time_weighted=True))
+        np.testing.assert_array_equal([1, 3], tcxindex.zone_counts(self.connection, [0, 105, 200], sport="running", start="2020-01", end="2020-02"))
+        np.testing.assert_array_equal([0, 0], tcxindex.zone_counts(self.connection, [0, 105, 200], start="2020-02"))
+        laps = tcxindex.lap_rows(self.connection)
+        self.assertEqual([0, 1], [lap["lap"] for lap in laps])
+        self.assertEqual(110., laps[0]["avg_bpm"])
+        self.assertIsInstance(laps[0]["trackpoints"], int)
+
+    def test_max_gap_change_keeps_other_files(self):
+        other = os.path.join(self.tmpdir, "other.tcx")
+        shutil.copy(self.filename, other)
+        self.assertEqual(2, tcxindex.ingest(self.connection, [self.filename, other], local_time=False)["ingested"])
+        counts = tcxindex.ingest(self.connection, [self.filename], max_gap=1, local_time=False)
+        self.assertEqual(1, counts["ingested"])
+        self.assertEqual(2, self.connection.execute("SELECT COUNT(*) FROM activities").fetchone()[0])
+        self.assertEqual(4, self.connection.execute("SELECT COUNT(*) FROM laps").fetchone()[0])
+        self.assertEqual([(1.,), (30.,)], self.connection.execute("SELECT max_gap FROM files ORDER BY max_gap").fetchall())
+        self.assertEqual(1, tcxindex.ingest(self.connection, [self.filename], max_gap=1, local_time=False)["unchanged"])
+
+    def test_month_argument(self):
+        self.assertEqual("2020-03", tcxindex.month("2020-3"))
+        for value in ["2020-1x", "2020-13", "2020"]:
+            with self.assertRaises(tcxindex.ArgumentTypeError):
+                tcxindex.month(value)
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.directory = os.path.join(self.tmpdir, "uploads")
+        os.mkdir(self.directory)
+        self.connection = tcxindex.connect(os.path.join(self.tmpdir, "index.db"))
+        self.addCleanup(self.connection.close)
+        self.summary = os.path.join(self.tmpdir, "summary.json")
+        self.publisher = tcxwatch.Publisher(self.summary)
+
+    def add_file(self, name, seed):
+        filename = os.path.join(self.directory, name)
+        synthtcx.write_synthetic_tcx(filename, laps=2, trackpoints_per_lap=100, seed=seed)
+        os.utime(filename, (0, 0))
+        return filename
+
+    def test_running_totals_follow_index(self):
+        self.add_file("a.tcx", 0)
+        # An archive file indexed earlier, with another max_gap, outside the watched directory
+        archive = os.path.join(self.tmpdir, "archive.tcx")
+        synthtcx.write_synthetic_tcx(archive, laps=1, trackpoints_per_lap=50, seed=2)
+        tcxindex.ingest(self.connection, [archive], max_gap=10, local_time=False)
+        totals = tcxwatch.RunningTotals([0, 120, 140, 200], [self.directory], time_weighted=True)
+        tcxwatch.watch(self.connection, [self.directory], totals, self.publisher, interval=0, local_time=False, polls=0)
+        self.add_file("b.tcx", 1)
+        os.remove(os.path.join(self.directory, "a.tcx"))
+        counts = tcxwatch.poll(self.connection, [self.directory], totals, self.publisher, local_time=False, prune=True)
+        self.assertEqual((1, 1), (counts["ingested"], counts["pruned"]))
+        # The watcher only prunes the watched directories: the deleted archive file stays indexed
+        os.remove(archive)
+        self.assertEqual(0, tcxwatch.poll(self.connection, [self.directory], totals, self.publisher, local_time=False, prune=True)["pruned"])
+        self.assertEqual(1, self.connection.execute("SELECT COUNT(*) FROM files WHERE path = ?", (archive,)).fetchone()[0])
+        tcxindex.ingest(self.connection, [self.directory], local_time=False, prune=True)
+        np.testing.assert_allclose(tcxindex.zone_counts(self.connection, [0, 120, 140, 200], time_weighted=True), totals.zone_counts())
+        with open(self.summary) as summary_file:
+            summary = json.load(summary_file)
+        self.assertEqual(1, summary["activities"])
+        self.assertEqual(2, len(summary["latest laps"]))
+        self.assertEqual(2, summary["version"])
+
+    def test_stationary_first_half_keeps_drift_finite(self):
+        self.add_file("a.tcx", 0)
+        # No distance covered in the first half of the first lap: its drift is infinite, and stored as NULL
+        stationary = os.path.join(self.directory, "stationary.tcx")
+        with open(stationary, "wb") as tcx_file:
+            tcx_file.write(SAMPLE_TCX.replace(b"<DistanceMeters>6.0</DistanceMeters>", b"<DistanceMeters>0.0</DistanceMeters>"))
+        os.utime(stationary, (0, 0))
+        totals = tcxwatch.RunningTotals([0, 120, 140, 200], [self.directory])
+        tcxwatch.watch(self.connection, [self.directory], totals, self.publisher, interval=0, local_time=False, polls=0)
+        os.remove(stationary)
+        self.assertEqual(1, tcxwatch.poll(self.connection, [self.directory], totals, self.publisher, local_time=False, prune=True)["pruned"])
+        expected = tcxindex.file_totals(self.connection)
+        for key in ["drift_laps", "drift", "bpm_only_drift_laps", "bpm_only_drift"]:
+            self.assertAlmostEqual(expected[key], totals.counts[key])
+        with open(self.summary) as summary_file:
+            self.assertAlmostEqual(expected["drift"] / expected["drift_laps"], json.load(summary_file)["mean drift"])
+
+    def test_summary_is_strict_json(self):
+        self.publisher.publish({"mean drift": float("inf"), "zones": [{"frequency": float("nan")}]})
+        with open(self.summary) as summary_file:
+            summary = json.load(summary_file, parse_constant=self.fail)
+        self.assertEqual((None, None), (summary["mean drift"], summary["zones"][0]["frequency"]))
+
+    def test_http_long_poll(self):
+        servers = tcxwatch.start_servers(self.publisher, ("127.0.0.1", 0))
+        self.addCleanup(tcxwatch.stop_servers, servers)
+        url = "http://127.0.0.1:{0}/?since=0".format(servers[0].server_address[1])
+        threading.Timer(0.1, self.publisher.publish, [{"zones": []}]).start()
+        self.assertEqual(1, json.loads(urlopen(url, timeout=5).read().decode())["version"])
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # 40 daily activities: January and February 2020
+        synthtcx.write_synthetic_tcx(os.path.join(self.tmpdir, "long.tcx"), activities=40, laps=1, trackpoints_per_lap=50)
+        synthtcx.write_synthetic_tcx(os.path.join(self.tmpdir, "short.tcx"), laps=2, trackpoints_per_lap=100, seed=1)
+        self.manifest = os.path.join(self.tmpdir, "club.json")
+        with open(self.manifest, "w") as manifest:
+            json.dump([{"athlete": "alice", "zones": "0,105,115,200", "files": "*.tcx"},
+                       {"athlete": "bob", "zones": [0, 100, 110, 120, 200], "files": ["short.tcx"]}], manifest)
+
+    def test_matches_tcxzones_per_athlete(self):
+        athletes = tcxbatch.read_manifest(self.manifest)
+        self.assertEqual(["alice", "bob"], [athlete.name for athlete in athletes])
+        grouped, skipped = tcxbatch.batch_zone_counts(athletes, time_weighted=True)
+        self.assertEqual([], skipped)
+        for athlete in athletes:
+            expected = tcxlib.compute_zone_distribution(athlete.files, athlete.zones_edges, time_weighted=True)
+            np.testing.assert_allclose(expected.counts, grouped[(athlete.name, "all")])
+        monthly, _ = tcxbatch.batch_zone_counts(athletes, group="month", jobs=2)
+        self.assertEqual([("alice", "2020-01"), ("alice", "2020-02"), ("bob", "2020-01")], list(monthly))
+        np.testing.assert_array_equal(tcxbatch.batch_zone_counts(athletes)[0][("alice", "all")],
+                                      monthly[("alice", "2020-01")] + monthly[("alice", "2020-02")])
+
+    def test_athlete_without_activities_keeps_rows(self):
+        manifest = os.path.join(self.tmpdir, "club.csv")
+        with open(manifest, "w") as manifest_file:
+            manifest_file.write('athlete,zones,files\ndave,"0,100,200",nobody/*.tcx\n')
+        process = subprocess.run([sys.executable, "tcxbatch.py", manifest], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        self.assertEqual("dave,all,Z0,\ndave,all,Z1,\n", process.stdout.decode())
+        self.assertIn("dave has no usable activities", process.stderr.decode())
+
+    def test_invalid_zones(self):
+        # A single edge delimits no zone
+        manifest = os.path.join(self.tmpdir, "club.csv")
+        with open(manifest, "w") as manifest_file:
+            manifest_file.write("athlete,zones,files\ncarol,120,*.tcx\n")
+        with self.assertRaises(ValueError):
+            tcxbatch.read_manifest(manifest)
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "sample.tcx")
+        with open(self.filename, "wb") as tcx_file:
+            tcx_file.write(SAMPLE_TCX)
+        self.cache = tcxcache.CacheSettings(os.path.join(self.directory, "cache"), 10 * tcxcache.MB, False)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_warm_load_matches_parse(self):
+        cold = tcxcache.load_columns(self.filename, self.cache)
+        warm = tcxcache.load_columns(self.filename, self.cache)
+        self.assertIsInstance(warm.time, np.memmap)
+        self.assertEqual(cold.laps, warm.laps)
+        self.assertEqual(cold.activities, warm.activities)
+        for name in tcxcache.COLUMNS:
+            np.testing.assert_array_equal(getattr(cold, name), getattr(warm, name))
+
+    def test_changed_file_gets_new_entry(self):
+        tcxcache.load_columns(self.filename, self.cache)
+        key = tcxcache.cache_key(self.filename)
+        with open(self.filename, "ab") as tcx_file:
+            tcx_file.write(b"\n")
+        self.assertNotEqual(key, tcxcache.cache_key(self.filename))
+
+    def test_evict(self):
+        tcxcache.load_columns(self.filename, self.cache)
+        self.assertEqual(1, len(os.listdir(self.cache.directory)))
+        tcxcache.evict(self.cache.directory, 0)
+        self.assertEqual(0, len(os.listdir(self.cache.directory)))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file